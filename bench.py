@@ -0,0 +1,336 @@
+#!/usr/bin/python
+"""
+Benchmarks for the KM client hot paths against a local stand-in tracker.
+
+    python bench.py [-n EVENTS] [--only NAME,...] [--agents FILE]
+                    [--json FILE] [--compare FILE]
+
+Each benchmark reports events/sec, the p50/p99 latency of a single call (a
+whole batch for `batched`, the whole drain for `spool-drain`), CPU time per
+event (all threads, from os.times) and objects per event: the growth in live
+GC-tracked objects over the run, which is what queueing modes hold on to
+(Python 2 has no tracemalloc to count every allocation).
+
+--json writes the results, together with the Python and package versions, so
+that a later run can be checked against them with --compare.
+
+The `formats` group sends the same events as GETs and as POSTed batches in
+each km.encoding format, and also reports the bytes each puts on the wire
+per event.
+"""
+import gc
+import json
+import os
+import platform
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import time
+import urllib
+from array import array
+from optparse import OptionParser
+
+from km import KM
+from km.asynckm import AsyncKM
+from km.encoding import GetEncoder, PostEncoder
+from km.helpers import is_robot
+from km.helpers.is_robot import cache_clear, classify
+from km.query import Event
+from km.testing import LoopbackServer
+from km.transport import ConnectionPool
+
+
+class OneShotKM(KM):
+    # The pre-pool behaviour: one TCP connection per event, whatever path
+    # (record, set, request) the event took to get here.
+    def submit(self, line):
+        host, port = self._host.split(':')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((host, int(port)))
+        sock.sendall('GET ' + line + ' HTTP/1.1\r\n'
+                     'Host: ' + host + '\r\nConnection: Close\r\n\r\n')
+        sock.close()
+
+
+PROPS = {'plan': 'pro', 'cohort': '2012-05', 'locale': 'en_US',
+         'referrer': 'http://example.com/landing?utm_source=news',
+         'items': 3, 'Billing Amount': '19.99'}
+
+
+def legacy_query_line(km, type, data):
+    # KM.request's serialization before QuerySerializer.
+    data['_t'] = km.now().strftime('%s')
+    data['_k'] = km._key
+    data['_p'] = km._id
+    query = []
+    for key, val in data.items():
+        query.append(urllib.quote(str(key)) + '=' + urllib.quote(str(val)))
+    return '/' + type + '?' + '&'.join(query)
+
+
+USER_AGENTS = [
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.19 (KHTML, like '
+    'Gecko) Chrome/18.0.1025.162 Safari/535.19',
+    'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_7_3) AppleWebKit/534.55.3 '
+    '(KHTML, like Gecko) Version/5.1.5 Safari/534.55.3',
+    'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.1; Trident/4.0)',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 5_1 like Mac OS X) AppleWebKit/534.46 '
+    '(KHTML, like Gecko) Version/5.1 Mobile/9B179 Safari/7534.48.3',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (compatible; bingbot/2.0; +http://www.bing.com/bingbot.htm)',
+    'Mozilla/5.0 (compatible; Yahoo! Slurp; '
+    'http://help.yahoo.com/help/us/ysearch/slurp)',
+    'Opera/9.80 (Windows NT 6.1; U; en) Presto/2.10.229 Version/11.62',
+    'curl/7.21.4 (universal-apple-darwin11.0) libcurl/7.21.4',
+    'Lynx/2.8.7rel.2 libwww-FM/2.14 SSL-MM/1.4.1 OpenSSL/1.0.0a',
+]
+
+
+def legacy_is_robot(user_agent):
+    # km.helpers.is_robot before it was compiled and cached.
+    if user_agent:
+        user_agent = unicode(user_agent).lower()
+        for agent in ('w3m', 'dillo', 'links', 'elinks', 'lynx'):
+            if agent in user_agent:
+                return False
+        for agent in ('bot', 'spider', 'search', 'jeeves', 'crawl', 'seek',
+                      'heritrix', 'slurp', 'thumbnails', 'capture', 'ferret',
+                      'webinator', 'scan', 'retriever', 'accelerator',
+                      'upload', 'digg', 'extractor', 'grub', 'scrub'):
+            if agent in user_agent:
+                return True
+        for agent in ('mozilla', 'browser', 'iphone', 'lynx', 'mobile',
+                      'opera', 'icab'):
+            if agent in user_agent:
+                break
+        else:
+            return True
+        if 'mozilla' in user_agent:
+            if '(' not in user_agent:
+                return True
+            if not re.search(r'mozilla/\d+', user_agent):
+                return True
+    return False
+
+
+def percentile(ordered, fraction):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(name, call, calls, per_call=1, finish=None):
+    """Time calls to call(i), then finish() if given; return a result."""
+    latencies = array('d')
+    clock = time.time
+    gc.collect()
+    objects = len(gc.get_objects())
+    cpu = sum(os.times()[:2])
+    start = clock()
+    for i in xrange(calls):
+        before = clock()
+        call(i)
+        latencies.append(clock() - before)
+    if finish is not None:
+        finish()
+    elapsed = clock() - start
+    cpu = sum(os.times()[:2]) - cpu
+    objects = len(gc.get_objects()) - objects
+    events = calls * per_call
+    ordered = sorted(latencies)
+    return {'name': name, 'events': events, 'seconds': elapsed,
+            'events_per_sec': events / elapsed if elapsed else 0,
+            'p50_us': percentile(ordered, 0.5) * 1e6,
+            'p99_us': percentile(ordered, 0.99) * 1e6,
+            'cpu_us_per_event': cpu / events * 1e6,
+            'objects_per_event': float(objects) / events}
+
+
+def bench_serializer(events):
+    km = KM('key')
+    km.identify('bench-user')
+    yield measure('legacy-query', lambda i: legacy_query_line(
+        km, 'e', dict(PROPS, _n='bench event')), events)
+    yield measure('serializer', lambda i: km.query_line(
+        'e', dict(PROPS, _n='bench event')), events)
+    yield measure('event', lambda i: km.event_line(
+        Event('e', 'bench-user', 'bench event', PROPS)), events)
+
+
+def bench_robots(events, agents):
+    corpus = agents * max(1, events // len(agents))
+    yield measure('legacy-robot', lambda i: legacy_is_robot(corpus[i]),
+                  len(corpus))
+    yield measure('classify', lambda i: classify(corpus[i]), len(corpus))
+    cache_clear()
+    yield measure('is_robot', lambda i: is_robot(corpus[i]), len(corpus))
+
+
+def record(km):
+    km.identify('bench-user')
+    return lambda i: km.record('bench event', {'i': i, 'plan': 'pro'})
+
+
+def bench_network(events, host):
+    km = OneShotKM('key', host=host, logging=False)
+    yield measure('one-shot', record(km), events)
+
+    pool = ConnectionPool()
+    km = KM('key', host=host, logging=False, pool=pool)
+    yield measure('sync', record(km), events)
+
+    km = KM('key', host=host, logging=False, pool=pool, background=True,
+            flush_interval=0.1)
+    yield measure('background', record(km), events, finish=km.flush)
+    km.close()
+
+    km = AsyncKM('key', host=host, logging=False, concurrency=4)
+    yield measure('async', record(km), events, finish=km.flush)
+    km.close()
+
+    batch_size = 100
+    km = KM('key', host=host, logging=False, pool=pool)
+    yield measure('batched', lambda i: km.record_many(
+        (('bench-user', 'bench event', {'i': j, 'plan': 'pro'})
+         for j in xrange(batch_size)), batch_size=batch_size),
+        max(1, events // batch_size), per_call=batch_size)
+    pool.clear()
+
+
+def bench_spool(events, host):
+    log_dir = tempfile.mkdtemp(prefix='km-bench-')
+    try:
+        km = KM('key', host=host, logging=False, use_cron=True,
+                log_dir=log_dir)
+        yield measure('spooled', record(km), events)
+        km.spool.sync()
+        pool = ConnectionPool()
+        sender = KM('key', host=host, logging=False, pool=pool,
+                    log_dir=log_dir)
+        yield measure('spool-drain', lambda i: sender.send_logged_queries(),
+                      1, per_call=events)
+        fill = record(km)
+        for i in xrange(events):
+            fill(i)
+        km.spool.sync()
+        yield measure('spool-replay', lambda i: sender.replay(workers=4), 1,
+                      per_call=events)
+        km.spool.close()
+        pool.clear()
+    finally:
+        shutil.rmtree(log_dir, ignore_errors=True)
+
+
+FORMATS = [('get', GetEncoder()),
+           ('post-jsonl', PostEncoder('jsonl', gzip=False)),
+           ('post-jsonl-gz', PostEncoder('jsonl')),
+           ('post-form', PostEncoder('form', gzip=False)),
+           ('post-form-gz', PostEncoder('form'))]
+
+
+def bench_formats(events, host):
+    batch_size = 100
+    km = KM('key', logging=False)
+    lines = [km.event_line(Event('e', 'user-%d' % (i % 50), 'bench event',
+                                 dict(PROPS, i=str(i))))
+             for i in xrange(batch_size)]
+    for name, encoder in FORMATS:
+        pool = ConnectionPool()
+        km = KM('key', host=host, logging=False, pool=pool, encoder=encoder)
+        result = measure(name, lambda i: km.send_queries(lines),
+                         max(1, events // batch_size), per_call=batch_size)
+        stats = km.stats()
+        result['bytes_per_event'] = (float(stats['bytes_sent']) /
+                                     stats['sent'])
+        pool.clear()
+        yield result
+
+
+def package_version():
+    try:
+        import pkg_resources
+        return pkg_resources.get_distribution('gcKISSmetrics').version
+    except Exception:
+        return None
+
+
+def report(results, baseline=None):
+    previous = dict((result['name'], result)
+                    for result in (baseline or {}).get('results', []))
+    print '%-14s %8s %12s %9s %9s %9s %8s %8s%s' % (
+        'benchmark', 'events', 'events/sec', 'p50 us', 'p99 us', 'cpu us',
+        'objs', 'bytes', '  vs baseline' if previous else '')
+    for result in results:
+        line = ('%(name)-14s %(events)8d %(events_per_sec)12.0f %(p50_us)9.1f '
+                '%(p99_us)9.1f %(cpu_us_per_event)9.2f '
+                '%(objects_per_event)8.3f' % result)
+        if 'bytes_per_event' in result:
+            line += ' %8.1f' % result['bytes_per_event']
+        else:
+            line += ' %8s' % '-'
+        old = previous.get(result['name'])
+        if old is not None and old['events_per_sec']:
+            line += '  %+6.1f%%' % (
+                (result['events_per_sec'] / old['events_per_sec'] - 1) * 100)
+        print line
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-n', '--events', type='int', default=5000,
+                      help='events per network benchmark (x20 for the '
+                           'in-memory ones)')
+    parser.add_option('--only', help='comma-separated groups to run: '
+                                     'serializer, robots, network, spool, '
+                                     'formats')
+    parser.add_option('--agents', help='user-agent corpus, one per line')
+    parser.add_option('--json', help='write results to this file')
+    parser.add_option('--compare', help='results file to compare against')
+    options, args = parser.parse_args(args)
+
+    groups = ['serializer', 'robots', 'network', 'spool', 'formats']
+    if options.only:
+        groups = options.only.split(',')
+    agents = USER_AGENTS
+    if options.agents:
+        agents = [line.rstrip('\n') for line in open(options.agents)
+                  if line.strip()]
+    baseline = None
+    if options.compare:
+        baseline = json.load(open(options.compare))
+
+    events = options.events
+    results = []
+    server = LoopbackServer(record=False)
+    host = server.host
+    try:
+        for group in groups:
+            if group == 'serializer':
+                results.extend(bench_serializer(events * 20))
+            elif group == 'robots':
+                results.extend(bench_robots(events * 20, agents))
+            elif group == 'network':
+                results.extend(bench_network(events, host))
+            elif group == 'spool':
+                results.extend(bench_spool(events, host))
+            elif group == 'formats':
+                results.extend(bench_formats(events, host))
+            else:
+                parser.error('unknown benchmark group %r' % group)
+    finally:
+        server.close()
+
+    report(results, baseline)
+    if options.json:
+        fh = open(options.json, 'w')
+        json.dump({'version': package_version(),
+                   'python': platform.python_version(),
+                   'platform': platform.platform(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                   'results': results}, fh, indent=2, sort_keys=True)
+        fh.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
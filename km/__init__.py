@@ -4,46 +4,269 @@ Example usage:
 km = KM('my-api-key')
 km.identify('simon')
 km.record('an event', {'attr': '1'})
+
+One KM can be shared by many threads if each call carries its own identity,
+either per call or through a lightweight handle:
+
+km.record('an event', {'attr': '1'}, identity='simon')
+km.bind('simon').record('an event')
+
+Give a user-agent, to identify() or bind() or per call, and events from
+robots (see km.helpers.is_robot) are dropped before anything is sent; the
+count is kept in km.robots_filtered:
+
+km.identify('simon', user_agent=request.headers.get('User-Agent'))
+
+Repeated set() calls with unchanged values can be dropped, and the rest
+merged per identity over a short window, by passing a coalescer:
+
+km = KM('my-api-key', coalescer=SetCoalescer(ttl=3600, window=1.0))
+
+High-volume events can be sampled per identity and capped per process:
+
+km = KM('my-api-key', sampler=EventSampler(rates={'page view': 0.1},
+                                           limits={'page view': 500}))
+
+Bulk imports stream through record_many/set_many/alias_many, which take
+iterables of tuples and report progress per batch:
+
+km.record_many(((user, 'signed up', {}, ts) for user, ts in rows),
+               on_batch=lambda batch: checkpoint(batch.end))
+
+Pass background=True (plus any km.dispatcher.Dispatcher options such as
+queue_size, flush_interval or overflow) to queue events and send them from a
+worker thread; call km.close() before exiting to deliver what is queued.
+
+The tracker's address is cached (see km.resolver), and km.warmup() resolves it
+and opens pooled connections at startup so the first events are not slowed
+down by DNS or connection setup.
+
+Sends are retried with backoff, and once the tracker host keeps failing its
+circuit breaker makes further sends fail fast (see km.transport). Pass
+spool_failures=True to keep events that could not be sent in the spool
+described below instead of dropping them.
+
+km.stats() returns counters (enqueued, sent, failed, dropped, bytes_sent),
+the queue depth, a send latency histogram and the connection pool's reuse
+figures. before_send(line), after_send(line, seconds) and on_error(line,
+error) hooks are called around every send attempt when given:
+
+km = KM('my-api-key', on_error=lambda line, error: alert(error))
+
+With use_cron=True nothing is sent inline: queries are appended to a durable
+spool in log_dir and delivered later by the `kissmetrics` console script,
+which pipelines them over a keep-alive connection (see KM.send_queries):
+
+kissmetrics <your_key> [log_dir] [host] [--every <seconds>]
+
+To catch up on a large backlog, --workers <n> sends it over n connections in
+parallel (keeping each identity's events in order) and --horizon <seconds>
+drops events older than that; see km.replay.
+
+Each event is a GET request by default. Where the tracker accepts batches,
+an encoder packs the lines of a drain, replay or background batch into
+gzipped POST bodies instead (see km.encoding):
+
+km = KM('my-api-key', background=True,
+        encoder=PostEncoder(format='jsonl', max_events=500))
+
+Under a pre-fork server (gunicorn, uwsgi) pools, worker threads and the spool
+are rebuilt in each child on first use (see km.forksafe). Giving the workers
+a per-process spool and running one `kissmetrics --every 5` sidecar per host
+sends everything over a single outbound pipeline:
+
+km = KM('my-api-key', use_cron=True, spool=Spool('/var/spool/km',
+                                                 per_process=True))
+
+Errors are logged to kissmetrics_error.log in log_dir from a background
+thread, and also reach any handlers on the stdlib "km" logger.
+
+Historical CSV or JSON-lines data can be backfilled with
+
+kissmetrics import <your_key> <file> [--checkpoint <file>] [--rate <n>] ...
 """
 
-import urllib
+import os
 import socket
+import sys
+import time
 from datetime import datetime
 
+from km.bulk import send_many
+from km.coalesce import SetCoalescer
+from km.dispatcher import Dispatcher
+from km.encoding import GetEncoder, PostEncoder
+from km.helpers.is_robot import default_detector
+from km.log import error_logger
+from km.query import Event, QuerySerializer
+from km.ratelimit import EventSampler
+from km.replay import Replay
+from km.spool import QUERY_LOG, SENDING_LOG, Spool
+from km.stats import Counters, Histogram
+from km.transport import CircuitOpenError, TransportError, default_pool
+
+LOG_NAMES = {
+    'error': 'kissmetrics_error.log',
+    'query': QUERY_LOG,
+    'send': SENDING_LOG,
+}
+
 class KM(object):
-    def __init__(self, key, host='trk.kissmetrics.com:80', logging=True):
+    def __init__(self, key, host='trk.kissmetrics.com:80', logging=True,
+                 pool=None, background=False, use_cron=False, log_dir='/tmp',
+                 robot_detector=None, spool_failures=False, coalescer=None,
+                 sampler=None, spool=None, before_send=None, after_send=None,
+                 on_error=None, encoder=None, **dispatch_options):
         self._key    = key
+        self._id = None
+        self._user_agent = None
+        self._robots = robot_detector or default_detector
+        self.robots_filtered = 0
         self._host = host
         self._logging = logging
+        self._logger = None
+        self._pool = pool or default_pool
+        self._use_cron = use_cron
+        self._spool_failures = spool_failures
+        self._coalescer = coalescer
+        self._sampler = sampler
+        if coalescer is not None:
+            coalescer.send = self._send_set
+        self._serializer = QuerySerializer()
+        self._counts = Counters('enqueued', 'sent', 'failed', 'bytes_sent')
+        self._latency = Histogram()
+        self.before_send = before_send
+        self.after_send = after_send
+        self.on_error = on_error
+        self.encoder = encoder or GetEncoder()
+        self.log_dir = log_dir
+        self.spool = spool or Spool(log_dir)
+        self.dispatcher = None
+        if background:
+            dispatch_options.setdefault('spill', self.log_query)
+            dispatch_options.setdefault('send_batch', self.send_queries)
+            self.dispatcher = Dispatcher(self.send_query, self.log_failure,
+                                         **dispatch_options)
 
-    def identify(self, id):
+    def identify(self, id, user_agent=None):
         self._id = id
+        self._user_agent = user_agent
+
+    def bind(self, id, user_agent=None):
+        return BoundKM(self, id, user_agent)
+
+    def is_robot(self, identity=None, user_agent=None):
+        # Events from robot user-agents are dropped before any other work.
+        if user_agent is None and identity is None:
+            user_agent = self._user_agent
+        if user_agent and self._robots.is_robot(user_agent):
+            self.robots_filtered += 1
+            return True
+        return False
 
-    def record(self, action, props={}):
-        self.check_id_key()
+    def record(self, action, props=None, identity=None, user_agent=None):
+        if self.is_robot(identity, user_agent):
+            return
+        self.check_id_key(identity)
         if isinstance(action, dict):
-            self.set(action)
+            self.set(action, identity)
+        if identity is None:
+            identity = self._id
 
-        props.update({'_n': action})
-        self.request('e', props)
+        if self._sampler is not None:
+            rate = self._sampler.admit(action, identity)
+            if rate is None:
+                return
+            if rate < 1:
+                props = dict(props or (), **{self._sampler.property: rate})
 
-    def set(self, data):
-        self.check_id_key()
-        self.request('s',data)
+        return self.send_event(Event('e', identity, action, props))
+
+    def set(self, data, identity=None, user_agent=None):
+        if self.is_robot(identity, user_agent):
+            return
+        self.check_id_key(identity)
+        if identity is None:
+            identity = self._id
+        if self._coalescer is not None and '_t' not in data:
+            data = self._coalescer.changed(identity, data)
+            if not data:
+                return
+            if self._coalescer.window:
+                self._coalescer.add(identity, data)
+                return
+        return self.send_event(Event('s', identity, props=data))
+
+    def _send_set(self, identity, data):
+        self.send_event(Event('s', identity, props=data))
 
     def alias(self, name, alias_to):
         self.check_init()
-        self.request('a', {'_n': alias_to, '_p': name}, False)
+        return self.send_event(Event('a', name=alias_to, props={'_p': name}))
+
+    def record_many(self, events, **options):
+        # events: (identity, action, props[, timestamp]) tuples
+        def lines():
+            for event in events:
+                identity, action, props = event[:3]
+                self.check_identify(identity)
+                if identity is None:
+                    identity = self._id
+                timestamp = event[3] if len(event) > 3 else None
+                yield self.event_line(Event('e', identity, action, props,
+                                            timestamp))
+        self.check_init()
+        return self.request_many(lines(), **options)
+
+    def set_many(self, events, **options):
+        # events: (identity, props[, timestamp]) tuples
+        def lines():
+            for event in events:
+                identity, props = event[:2]
+                self.check_identify(identity)
+                if identity is None:
+                    identity = self._id
+                timestamp = event[2] if len(event) > 2 else None
+                yield self.event_line(Event('s', identity, None, props,
+                                            timestamp))
+        self.check_init()
+        return self.request_many(lines(), **options)
+
+    def alias_many(self, aliases, **options):
+        # aliases: (name, alias_to) tuples
+        def lines():
+            for name, alias_to in aliases:
+                yield self.event_line(Event('a', name=alias_to,
+                                            props={'_p': name}))
+        self.check_init()
+        return self.request_many(lines(), **options)
+
+    def request_many(self, lines, batch_size=1000, connections=4,
+                     on_batch=None):
+        if self._use_cron:
+            sent = 0
+            for line in lines:
+                self.log_query(line)
+                sent += 1
+            return sent, 0
+        return send_many(self, lines, batch_size, connections, on_batch)
+
+    def log_name(self, name):
+        return os.path.join(self.log_dir, LOG_NAMES.get(name, ''))
 
     def log_file(self):
-        return '/tmp/kissmetrics_error.log'
+        return self.log_name('error')
+
+    def log_query(self, line):
+        self.spool.append(line)
 
     def reset(self):
         self._id = None
+        self._user_agent = None
         self._key = None
 
-    def check_identify(self):
-        if self._id == None:
+    def check_identify(self, identity=None):
+        if identity is None and self._id == None:
             raise Exception, "Need to identify first (KM.identify <user>)"
 
     def check_init(self):
@@ -53,50 +276,271 @@ class KM(object):
     def now(self):
         return datetime.utcnow()
 
-    def check_id_key(self):
+    def check_id_key(self, identity=None):
         self.check_init()
-        self.check_identify()
+        self.check_identify(identity)
 
     def logm(self, msg):
         if not self._logging:
             return
-        msg = self.now().strftime('<%c> ') + msg
+        if self._logger is None:
+            self._logger = error_logger(self.log_file())
+        self._logger.error(msg)
+
+    def query_line(self, type, data, update=True, identity=None):
+        if identity is None:
+            identity = self._id
+        return self._serializer.line(type, data, self._key, identity, update)
+
+    def event_line(self, event):
+        return event.line(self._key, self._serializer)
+
+    def send_event(self, event):
+        return self.submit(self.event_line(event))
+
+    def request(self, type, data, update=True, identity=None):
+        return self.submit(self.query_line(type, data, update, identity))
+
+    def submit(self, line):
+        self._counts.incr('enqueued')
+        if self._use_cron:
+            try:
+                self.log_query(line)
+            except (IOError, OSError):
+                self.logm("Could not write to " + self.log_name('query'))
+            return
+
+        if self.dispatcher is not None:
+            self.dispatcher.put(line)
+            return
+
         try:
-            fh = open(self.log_file(), 'a')
-            fh.write(msg)
-            fh.close()
-        except IOError:
-            pass #just discard at this point
-
-    def request(self, type, data, update=True):
-        query = []
-
-        # if user has defined their own _t, then include necessary _d
-        if '_t' in data:
-            data['_d'] = 1
-        else:
-            data['_t'] = self.now().strftime('%s')
+            self.send_query(line)
+        except Exception, e:
+            self.log_failure(line, e)
+
+    def http_request(self, line):
+        return self.encoder.request(self._host.split(':')[0], line)
 
-        # add customer key to data sent
-        data['_k'] = self._key
+    def send_query(self, line, pool=None):
+        if self.before_send is not None:
+            self.before_send(line)
+        start = time.time()
+        try:
+            data = self.http_request(line)
+            (pool or self._pool).send(self._host, data)
+        except Exception, e:
+            self._counts.incr('failed')
+            if self.on_error is not None:
+                self.on_error(line, e)
+            raise
+        elapsed = time.time() - start
+        self._latency.observe(elapsed)
+        self._counts.incr('sent')
+        self._counts.incr('bytes_sent', len(data))
+        if self.after_send is not None:
+            self.after_send(line, elapsed)
 
-        if update:
-            data['_p'] = self._id
+    def send_queries(self, lines, pool=None):
+        """Pipeline several query lines over one connection, batched as
+        the encoder allows; return an error, or None if it was delivered,
+        for each line."""
+        if self.before_send is not None:
+            for line in lines:
+                self.before_send(line)
+        batches = self._batches(lines)
+        start = time.time()
+        requests = [data for data, count in batches
+                    if not isinstance(data, Exception)]
+        results = iter((pool or self._pool).pipeline(self._host, requests)
+                       if requests else ())
+        # Per-line latency is not observable when pipelining; use the mean.
+        elapsed = (time.time() - start) / (len(lines) or 1)
+        errors = []
+        for data, count in batches:
+            if isinstance(data, Exception):
+                error = data
+            else:
+                error = next(results)
+            batch = lines[len(errors):len(errors) + count]
+            errors.extend([error] * count)
+            if error is None:
+                self._counts.incr('sent', count)
+                self._counts.incr('bytes_sent', len(data))
+            else:
+                self._counts.incr('failed', count)
+            for line in batch:
+                if error is None:
+                    self._latency.observe(elapsed)
+                    if self.after_send is not None:
+                        self.after_send(line, elapsed)
+                elif self.on_error is not None:
+                    self.on_error(line, error)
+        return errors
 
-        for key, val in data.items():
-            query.append(urllib.quote(str(key)) + '=' + urllib.quote(str(val)))
+    def _batches(self, lines):
+        # [(request, lines it carries)], with the error in place of the
+        # request for a line that could not be encoded.
+        host = self._host.split(':')[0]
+        try:
+            return self.encoder.batches(host, lines)
+        except Exception:
+            # Encode one line at a time so a bad line fails on its own.
+            batches = []
+            for line in lines:
+                try:
+                    batches.extend(self.encoder.batches(host, [line]))
+                except Exception, e:
+                    batches.append((e, 1))
+            return batches
 
+    def warmup(self, connections=1):
+        """Resolve the tracker host and open pooled connections to it
+        ahead of the first send. Returns how many were opened."""
         try:
-            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            host, port = self._host.split(':')
-            sock.connect((host, int(port)))
-            sock.setblocking(0) # 0 is non-blocking
-
-            get = 'GET /' + type + '?' + '&'.join(query) + " HTTP/1.1\r\n"
-            out = get
-            out += "Host: " + host + "\r\n"
-            out += "Connection: Close\r\n\r\n";
-            sock.send(out)
-            sock.close()
-        except:
+            return self._pool.warmup(self._host, connections)
+        except (socket.error, TransportError):
+            self.logm("Could not connect to " + self._host)
+            return 0
+
+    def queue_depth(self):
+        if self.dispatcher is not None:
+            return self.dispatcher.depth
+        return 0
+
+    def stats(self):
+        stats = self._counts.snapshot()
+        dropped = {'robots': self.robots_filtered}
+        if self._sampler is not None:
+            sampler = self._sampler.stats()
+            dropped['sampled_out'] = sum(sampler['sampled_out'].values())
+            dropped['rate_limited'] = sum(sampler['rate_limited'].values())
+        if self.dispatcher is not None:
+            dropped['overflow'] = self.dispatcher.dropped
+            stats['dispatcher'] = self.dispatcher.stats()
+        if self._coalescer is not None:
+            stats['coalescer'] = self._coalescer.stats()
+        stats['dropped'] = sum(dropped.values())
+        stats['dropped_by'] = dropped
+        stats['queue_depth'] = self.queue_depth()
+        stats['latency'] = self._latency.snapshot()
+        stats['pool'] = self._pool.stats()
+        return stats
+
+    def log_failure(self, line, error):
+        if self._coalescer is not None:
+            self._coalescer.forget(line)
+        if self._spool_failures:
+            try:
+                self.log_query(line)
+            except (IOError, OSError):
+                pass
+        if not isinstance(error, CircuitOpenError):
             self.logm("Could not transmit to " + self._host)
+
+    def flush(self):
+        if self._coalescer is not None:
+            self._coalescer.flush()
+        if self.dispatcher is not None:
+            self.dispatcher.flush()
+
+    def close(self):
+        if self._coalescer is not None:
+            self._coalescer.flush()
+        if self.dispatcher is not None:
+            self.dispatcher.close()
+        self.spool.close()
+
+    def send_logged_queries(self):
+        sent, failed = self.spool.drain(send_batch=self.send_queries)
+        if failed:
+            self.logm("Could not transmit to " + self._host)
+        return sent, failed
+
+    def replay(self, **options):
+        """Send the spool with km.replay.Replay(self, **options); returns
+        its Progress."""
+        progress = Replay(self, **options).run()
+        if progress.failed:
+            self.logm("Could not transmit to " + self._host)
+        return progress
+
+
+class BoundKM(object):
+    # A KM bound to one identity. Any number of these can share a single
+    # KM (and its connection pool and caches) across threads, since the
+    # identity travels with each call instead of living on the KM.
+    __slots__ = ('km', 'identity', 'user_agent')
+
+    def __init__(self, km, identity, user_agent=None):
+        self.km = km
+        self.identity = identity
+        self.user_agent = user_agent
+
+    def record(self, action, props=None):
+        return self.km.record(action, props, self.identity, self.user_agent)
+
+    def set(self, data):
+        return self.km.set(data, self.identity, self.user_agent)
+
+    def alias(self, alias_to):
+        return self.km.alias(self.identity, alias_to)
+
+
+def _option(args, name, type):
+    # Remove "name value" from args and return the value, or None.
+    if name not in args:
+        return None
+    i = args.index(name)
+    value = type(args[i + 1])
+    del args[i:i + 2]
+    return value
+
+
+def main(*args):
+    args = list(args or sys.argv)
+    if len(args) < 2:
+        sys.stderr.write("At least one argument required. "
+                         "Usage: %s <your_key> [log_dir] [host] "
+                         "[--every <seconds>] [--workers <n>] "
+                         "[--horizon <seconds>] or "
+                         "%s import <your_key> <file> [options]\n" %
+                         (args[0], args[0]))
+        return 1
+    if args[1] == 'import':
+        from km.importer import main as import_main
+        return import_main(args)
+
+    every = _option(args, '--every', float)
+    workers = _option(args, '--workers', int)
+    horizon = _option(args, '--horizon', float)
+    options = {}
+    if len(args) > 2:
+        options['log_dir'] = args[2]
+    if len(args) > 3:
+        options['host'] = args[3]
+    km = KM(args[1], **options)
+
+    while True:
+        start = time.time()
+        if workers or horizon:
+            progress = km.replay(workers=workers or 4, horizon=horizon)
+            sent, failed = progress.sent, progress.failed
+        else:
+            progress = None
+            sent, failed = km.send_logged_queries()
+        elapsed = time.time() - start
+        if sent or every is None:
+            print "Sent %d queries in %.2fs (%.0f/sec)" % (
+                sent, elapsed, sent / elapsed if elapsed else 0)
+        if progress is not None and (progress.duplicates or
+                                     progress.expired):
+            print "Dropped %d duplicate and %d expired queries" % (
+                progress.duplicates, progress.expired)
+        if failed:
+            sys.stderr.write("Could not transmit to %s; the rest of the "
+                             "spool will be retried on the next run\n" %
+                             km._host)
+        if every is None:
+            return 2 if failed else 0
+        time.sleep(every)
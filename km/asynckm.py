@@ -0,0 +1,134 @@
+"""
+Non-blocking KM client.
+
+AsyncKM builds queries on the caller's thread with the same code as KM, so the
+wire output is identical, and hands the network send to a fixed pool of sender
+threads. record/set/alias return a Result that can be waited on;
+track_nowait is fire-and-forget. Events that are never sent from here
+(dropped as robots, sampled out or coalesced, or handed to the spool or a
+background dispatcher) return a Result that is already done.
+
+Example usage:
+
+km = AsyncKM('my-api-key', concurrency=8, timeout=2)
+km.identify('simon')
+km.record('an event', {'attr': '1'}).wait(1)
+km.track_nowait('page view')
+km.close()
+"""
+
+import os
+import threading
+from Queue import Queue
+
+from km import KM
+from km.forksafe import ForkAware
+from km.transport import ConnectionPool
+
+
+class Result(object):
+    __slots__ = ('line', 'error', '_done')
+
+    def __init__(self, line, done=False):
+        self.line = line
+        self.error = None
+        self._done = threading.Event()
+        if done:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def get(self, timeout=None):
+        if not self._done.wait(timeout):
+            raise RuntimeError("Timed out waiting for " + self.line)
+        if self.error is not None:
+            raise self.error
+
+
+class AsyncKM(KM, ForkAware):
+    def __init__(self, key, host='trk.kissmetrics.com:80', logging=True,
+                 concurrency=4, timeout=5, pool=None, **options):
+        self._owns_pool = pool is None
+        pool = pool or ConnectionPool(maxsize=concurrency, timeout=timeout)
+        super(AsyncKM, self).__init__(key, host, logging, pool, **options)
+        self.concurrency = concurrency
+        self._start()
+
+    def _start(self):
+        self._jobs = Queue()
+        self._workers = []
+        self._pid = os.getpid()
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self._work,
+                                      name='km-async-%d' % i)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            result = self._jobs.get()
+            if result is None:
+                self._jobs.task_done()
+                return
+            try:
+                self.send_query(result.line)
+            except Exception, e:
+                result.error = e
+                self.log_failure(result.line, e)
+            result._done.set()
+            self._jobs.task_done()
+
+    def _after_fork(self):
+        # Jobs queued before the fork are sent by the parent.
+        if self._workers:
+            self._start()
+
+    def record(self, action, props=None, identity=None, user_agent=None):
+        result = super(AsyncKM, self).record(action, props, identity,
+                                             user_agent)
+        return result or Result(None, done=True)
+
+    def set(self, data, identity=None, user_agent=None):
+        result = super(AsyncKM, self).set(data, identity, user_agent)
+        return result or Result(None, done=True)
+
+    def alias(self, name, alias_to):
+        return (super(AsyncKM, self).alias(name, alias_to) or
+                Result(None, done=True))
+
+    def submit(self, line):
+        self._check_fork()
+        if self._use_cron or self.dispatcher is not None:
+            super(AsyncKM, self).submit(line)
+            return Result(line, done=True)
+        result = Result(line)
+        self._counts.incr('enqueued')
+        self._jobs.put(result)
+        return result
+
+    def queue_depth(self):
+        return self._jobs.qsize() + super(AsyncKM, self).queue_depth()
+
+    def track_nowait(self, action, props=None, identity=None, user_agent=None):
+        self.record(action, props, identity, user_agent)
+
+    def flush(self):
+        self._check_fork()
+        self._jobs.join()
+        super(AsyncKM, self).flush()
+
+    def close(self):
+        self._check_fork()
+        for worker in self._workers:
+            self._jobs.put(None)
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+        super(AsyncKM, self).close()
+        if self._owns_pool:
+            self._pool.clear()
@@ -0,0 +1,78 @@
+"""
+Bulk sending for KM.record_many, KM.set_many and KM.alias_many.
+
+Queries are consumed lazily from the caller's iterable, so generators of any
+length stream through in constant memory. Each batch is fanned out over a
+small set of keep-alive connections with at most `connections` requests in
+flight, and on_batch is called once the whole batch has been attempted.
+"""
+
+import threading
+from collections import namedtuple
+from itertools import islice
+from Queue import Queue
+
+from km.transport import ConnectionPool
+
+Batch = namedtuple('Batch', 'start end sent failed')
+
+
+def send_many(km, lines, batch_size=1000, connections=4, on_batch=None):
+    """Send every query line, returning the total (sent, failed)."""
+    pool = km._pool
+    if isinstance(pool, ConnectionPool):
+        pool = ConnectionPool(maxsize=connections, timeout=pool.timeout,
+                              connect_timeout=pool.connect_timeout,
+                              retry=pool.retry, resolver=pool.resolver)
+    jobs = Queue(maxsize=connections)
+    counts = {'sent': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            line = jobs.get()
+            if line is None:
+                jobs.task_done()
+                return
+            try:
+                km.send_query(line, pool)
+                outcome = 'sent'
+            except Exception, e:
+                outcome = 'failed'
+                km.log_failure(line, e)
+            with lock:
+                counts[outcome] += 1
+            jobs.task_done()
+
+    workers = [threading.Thread(target=work) for i in range(connections)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+
+    lines = iter(lines)
+    start = sent = failed = 0
+    try:
+        while True:
+            batch = list(islice(lines, batch_size))
+            if not batch:
+                break
+            for line in batch:
+                jobs.put(line)
+            jobs.join()
+            with lock:
+                result = Batch(start, start + len(batch), counts['sent'],
+                               counts['failed'])
+                counts['sent'] = counts['failed'] = 0
+            sent += result.sent
+            failed += result.failed
+            start = result.end
+            if on_batch is not None:
+                on_batch(result)
+    finally:
+        for worker in workers:
+            jobs.put(None)
+        for worker in workers:
+            worker.join()
+        if pool is not km._pool:
+            pool.clear()
+    return sent, failed
@@ -0,0 +1,126 @@
+"""
+Coalescing of redundant KM.set calls.
+
+The coalescer remembers the last value sent for each (identity, property),
+in a bounded LRU with a TTL, and drops properties whose value has not
+changed. With a window, the remaining updates for an identity are merged
+and sent as one set request once the window has passed (or on KM.flush()).
+
+A property is remembered as soon as it is handed on to be sent; if that
+send fails KM calls forget() with the failed query, so the next set() of the
+same value is sent again instead of being suppressed until the entry expires.
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from km.encoding import parse_query
+from km.forksafe import ForkAware
+
+
+def _identity(identity):
+    # Entries are keyed by identity as it appears in the query line, so
+    # forget() can find them from a failed line.
+    if isinstance(identity, unicode):
+        return identity.encode('utf-8')
+    return str(identity)
+
+
+class SetCoalescer(ForkAware):
+    def __init__(self, maxsize=10000, ttl=3600, window=0, clock=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.window = window
+        self.clock = clock
+        self.send = None
+
+        self.calls = 0
+        self.properties = 0
+        self.suppressed = 0
+        self.merged = 0
+
+        self._values = OrderedDict()
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _after_fork(self):
+        # The parent sends what it had pending; its timer did not survive.
+        self._pending = {}
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def stats(self):
+        return {'calls': self.calls, 'properties': self.properties,
+                'suppressed': self.suppressed, 'merged': self.merged,
+                'size': len(self._values)}
+
+    def changed(self, identity, data):
+        """Return the part of data that differs from what was last sent."""
+        self._check_fork()
+        now = self.clock()
+        values = self._values
+        changed = {}
+        with self._lock:
+            self.calls += 1
+            identity = _identity(identity)
+            for name, value in data.iteritems():
+                self.properties += 1
+                key = (identity, name)
+                value = str(value)
+                entry = values.pop(key, None)
+                if entry is not None and entry[0] == value and \
+                        entry[1] > now:
+                    values[key] = entry
+                    self.suppressed += 1
+                    continue
+                values[key] = (value, now + self.ttl)
+                changed[name] = value
+            while len(values) > self.maxsize:
+                values.popitem(last=False)
+        return changed
+
+    def forget(self, line):
+        """Drop the values carried by a set query line that could not be
+        sent, so they are not suppressed next time."""
+        type, params = parse_query(line)
+        if type != 's' or '_p' not in params:
+            return
+        identity = params['_p']
+        with self._lock:
+            for name, value in params.iteritems():
+                key = (identity, name)
+                entry = self._values.get(key)
+                if entry is not None and entry[0] == value:
+                    del self._values[key]
+
+    def add(self, identity, data):
+        """Queue data to be merged into identity's next set request."""
+        with self._lock:
+            pending = self._pending.get(identity)
+            if pending is None:
+                self._pending[identity] = dict(data)
+            else:
+                pending.update(data)
+                self.merged += 1
+            if self._timer is None:
+                self._timer = threading.Timer(self.window, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        self._check_fork()
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+        for identity, data in pending.iteritems():
+            self.send(identity, data)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
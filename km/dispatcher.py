@@ -0,0 +1,168 @@
+"""
+Background dispatcher for KM's asynchronous mode.
+
+Queries are queued as request paths ("/e?_n=...") and a daemon worker thread
+drains the queue in batches, so the caller's thread never touches the
+network. Given send_batch, each batch is handed over whole (KM pipelines it,
+or packs it into POST bodies); otherwise lines are sent one at a time.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+from km.forksafe import ForkAware
+
+OVERFLOW_POLICIES = ('drop-oldest', 'block', 'spill')
+
+
+class Dispatcher(ForkAware):
+    def __init__(self, send, on_error=None, queue_size=10000,
+                 flush_interval=1.0, batch_size=100, overflow='drop-oldest',
+                 spill=None, send_batch=None):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError("overflow must be one of %s" %
+                             ', '.join(OVERFLOW_POLICIES))
+        if overflow == 'spill' and spill is None:
+            raise ValueError("overflow='spill' needs a spill callable")
+        self.send = send
+        self.send_batch = send_batch
+        self.on_error = on_error
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.overflow = overflow
+        self.spill = spill
+
+        self.sent = 0
+        self.failed = 0
+        self.dropped = 0
+        self.spilled = 0
+
+        self._closed = False
+        self._start()
+
+    def _start(self):
+        self._queue = deque()
+        self._inflight = 0
+        self._flushing = 0
+        self._lock = threading.Lock()
+        self._has_work = threading.Condition(self._lock)
+        self._changed = threading.Condition(self._lock)
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run,
+                                        name='km-dispatcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _after_fork(self):
+        # Whatever was queued belongs to the parent, which will send it.
+        if not self._closed:
+            self._start()
+
+    @property
+    def depth(self):
+        return len(self._queue) + self._inflight
+
+    def stats(self):
+        return {'depth': self.depth, 'sent': self.sent,
+                'failed': self.failed, 'dropped': self.dropped,
+                'spilled': self.spilled}
+
+    def put(self, line):
+        self._check_fork()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError("Dispatcher is closed")
+            if len(self._queue) >= self.queue_size:
+                if self.overflow == 'block':
+                    while len(self._queue) >= self.queue_size:
+                        self._changed.wait()
+                elif self.overflow == 'drop-oldest':
+                    self._queue.popleft()
+                    self.dropped += 1
+                else:
+                    self._spill(line)
+                    return
+            self._queue.append(line)
+            if len(self._queue) == 1 or len(self._queue) >= self.batch_size:
+                self._has_work.notify()
+
+    def _spill(self, line):
+        try:
+            self.spill(line)
+            self.spilled += 1
+        except (IOError, OSError):
+            self.dropped += 1
+
+    def flush(self):
+        self._check_fork()
+        with self._lock:
+            self._flushing += 1
+            self._has_work.notify()
+            try:
+                while self._queue or self._inflight:
+                    self._changed.wait()
+            finally:
+                self._flushing -= 1
+
+    def close(self):
+        self._check_fork()
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._has_work.notify()
+        self._thread.join()
+
+    def _next_batch(self):
+        with self._lock:
+            while not self._queue and not self._closed:
+                self._has_work.wait()
+            deadline = time.time() + self.flush_interval
+            while (len(self._queue) < self.batch_size and
+                   not (self._closed or self._flushing)):
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._has_work.wait(remaining)
+            queue = self._queue
+            batch = [queue.popleft()
+                     for i in xrange(min(len(queue), self.batch_size))]
+            self._inflight = len(batch)
+            self._changed.notify_all()
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if not batch and self._closed:
+                return
+            if self.send_batch is not None and batch:
+                self._send_batch(batch)
+            else:
+                for line in batch:
+                    try:
+                        self.send(line)
+                        self.sent += 1
+                    except Exception, e:
+                        self.failed += 1
+                        if self.on_error is not None:
+                            self.on_error(line, e)
+            with self._lock:
+                self._inflight = 0
+                self._changed.notify_all()
+
+    def _send_batch(self, batch):
+        try:
+            errors = self.send_batch(batch)
+        except Exception, e:
+            errors = [e] * len(batch)
+        for line, error in zip(batch, errors):
+            if error is None:
+                self.sent += 1
+            else:
+                self.failed += 1
+                if self.on_error is not None:
+                    self.on_error(line, error)
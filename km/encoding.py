@@ -0,0 +1,131 @@
+"""
+Wire formats for KM's requests.
+
+An encoder turns query lines ("/e?_k=...&_p=...&_n=...") into raw HTTP
+requests. GetEncoder, the default, sends one line per GET request, the
+format the tracker has always accepted. PostEncoder packs many lines into one
+POST body, either as JSON lines ({"type": "e", "params": {...}}) or as the
+form-encoded query strings one per line, optionally gzip-compressed, and
+splits batches at max_events lines or max_bytes of uncompressed body. JSON
+can only carry UTF-8 values, so a jsonl line holding other bytes is sent as
+a GET of its own, in its place in the batch order:
+
+km = KM('key', encoder=PostEncoder(format='jsonl', max_events=500))
+
+Batches are formed wherever several lines are sent together: spool drains,
+replays and background mode. A single call sends a batch of one.
+"""
+
+import json
+import urllib
+import urlparse
+import zlib
+
+FORMATS = {'jsonl': 'application/x-ndjson',
+           'form': 'application/x-www-form-urlencoded'}
+
+
+def parse_query(line):
+    """Split a query line ("/e?_n=...&_p=...") into (type, params)."""
+    path, _, query = line.partition('?')
+    return path.lstrip('/'), dict(urlparse.parse_qsl(query, True))
+
+
+class GetEncoder(object):
+    def request(self, host, line):
+        return 'GET ' + line + ' HTTP/1.1\r\nHost: ' + host + '\r\n\r\n'
+
+    def batches(self, host, lines):
+        """Return [(request, number of lines it carries)] for lines."""
+        return [(self.request(host, line), 1) for line in lines]
+
+
+class PostEncoder(GetEncoder):
+    def __init__(self, format='jsonl', gzip=True, path='/batch',
+                 max_events=500, max_bytes=256 * 1024, compresslevel=6):
+        if format not in FORMATS:
+            raise ValueError("format must be one of %s" %
+                             ', '.join(sorted(FORMATS)))
+        self.format = format
+        self.gzip = gzip
+        self.path = path
+        self.max_events = max_events
+        self.max_bytes = max_bytes
+        self.compresslevel = compresslevel
+
+    def encode_line(self, line):
+        """Return line as it goes in a batch body, or None if the format
+        cannot carry it."""
+        if self.format == 'form':
+            return line
+        type, params = parse_query(line)
+        try:
+            return json.dumps({'type': type, 'params': params},
+                              separators=(',', ':'))
+        except UnicodeDecodeError:
+            return None
+
+    def post(self, host, body):
+        head = ['POST ' + self.path + ' HTTP/1.1',
+                'Host: ' + host,
+                'Content-Type: ' + FORMATS[self.format]]
+        if self.gzip:
+            compressor = zlib.compressobj(self.compresslevel, zlib.DEFLATED,
+                                          16 + zlib.MAX_WBITS)
+            body = compressor.compress(body) + compressor.flush()
+            head.append('Content-Encoding: gzip')
+        head.append('Content-Length: %d' % len(body))
+        return '\r\n'.join(head) + '\r\n\r\n' + body
+
+    def request(self, host, line):
+        encoded = self.encode_line(line)
+        if encoded is None:
+            return GetEncoder.request(self, host, line)
+        return self.post(host, encoded + '\n')
+
+    def batches(self, host, lines):
+        batches = []
+        body = []
+        size = 0
+        for line in lines:
+            encoded = self.encode_line(line)
+            if body and (encoded is None or len(body) >= self.max_events or
+                         size + len(encoded) + 1 > self.max_bytes):
+                batches.append((self.post(host, ''.join(body)), len(body)))
+                body = []
+                size = 0
+            if encoded is None:
+                batches.append((GetEncoder.request(self, host, line), 1))
+                continue
+            body.append(encoded + '\n')
+            size += len(encoded) + 1
+        if body:
+            batches.append((self.post(host, ''.join(body)), len(body)))
+        return batches
+
+
+def decode(request):
+    """Return the query lines carried by a raw request from an encoder."""
+    head, _, body = request.partition('\r\n\r\n')
+    lines = head.split('\r\n')
+    method, path = lines[0].split(' ', 2)[:2]
+    if method == 'GET':
+        return [path]
+    headers = dict((name.strip().lower(), value.strip()) for name, _, value
+                   in (line.partition(':') for line in lines[1:]))
+    return decode_body(headers, body)
+
+
+def decode_body(headers, body):
+    if headers.get('content-encoding') == 'gzip':
+        body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+    if headers.get('content-type') == FORMATS['form']:
+        return body.splitlines()
+    lines = []
+    for line in body.splitlines():
+        query = json.loads(line)
+        params = dict((name.encode('utf-8'), value.encode('utf-8'))
+                      for name, value in query['params'].iteritems())
+        lines.append('/' + str(query['type']) + '?' +
+                     urllib.urlencode(params))
+    return lines
@@ -0,0 +1,24 @@
+"""
+Support for pre-fork servers (gunicorn, uwsgi, ...).
+
+Threads do not survive os.fork(), locks may be copied in a held state and
+sockets end up shared between parent and child. Python 2 has no
+os.register_at_fork, so objects that own such state derive from ForkAware:
+they remember the pid that built that state and rebuild it in _after_fork()
+the first time they are used from a different process.
+"""
+
+import os
+
+
+class ForkAware(object):
+    # Subclasses set self._pid = os.getpid() when they build their state and
+    # call _check_fork() at their entry points.
+    def _check_fork(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            self._pid = pid
+            self._after_fork()
+
+    def _after_fork(self):
+        raise NotImplementedError
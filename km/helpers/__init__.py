@@ -1 +1 @@
-from km.helpers.is_robot import is_robot
+from km.helpers.is_robot import is_robot, is_robot_many, RobotDetector
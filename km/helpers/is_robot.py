@@ -1,45 +1,204 @@
+import json
+import os
 import re
+import threading
+import time
 
+# We mark something as a bot if it contains any of the bot indicators
+# or if it does not contain one of the browser indicators. In addition,
+# if the user-agent string contains "mozilla" we make sure it has version
+# information. Finally anything that contains a word in the whitelist
+# is never considered a bot.
+#
+# The word lists live in a JSON file with "whitelist", "bot" and "browser"
+# keys; robot_signatures.json next to this module is the default.
+SIGNATURES = os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                          'robot_signatures.json')
 
-def is_robot(user_agent):
-  if user_agent:
+_MOZILLA_VERSION = re.compile(r'mozilla/\d+')
+
+
+def _alternation(words):
+  if not words:
+    return re.compile('(?!)')  # never matches
+  return re.compile('|'.join(re.escape(word.lower()) for word in words))
+
+
+class SignatureIndex(object):
+  # Each word list is compiled into a single alternation so it is checked
+  # in one scan of the user-agent instead of one substring search per word.
+  def __init__(self, signatures):
+    self.signatures = signatures
+    self.whitelist = _alternation(signatures['whitelist'])
+    self.bot = _alternation(signatures['bot'])
+    self.browser = _alternation(signatures['browser'])
+
+  def classify(self, user_agent):
+    if not user_agent:
+      return False
+    if isinstance(user_agent, str):
+      # Header values are bytes and need not be ASCII.
+      user_agent = user_agent.decode('utf-8', 'replace')
     user_agent = unicode(user_agent).lower()
 
-    # We mark something as a bot if it contains any of the $bot_indicators
-    # or if it does not contain one of the $browser_indicators. In addition,
-    # if the user-agent string contains "mozilla" we make sure it has version
-    # information. Finally anything that starts with a word in the $whitelist
-    # is never considered a bot.
-
-    whitelist = ('w3m', 'dillo', 'links', 'elinks', 'lynx')
-    for agent in whitelist:
-        if agent in user_agent:
-            return False
-
-    bot_indicators = ('bot', 'spider', 'search', 'jeeves', 'crawl', 'seek',
-                      'heritrix', 'slurp', 'thumbnails', 'capture', 'ferret',
-                      'webinator', 'scan', 'retriever', 'accelerator',
-                      'upload', 'digg', 'extractor', 'grub', 'scrub')
-    for agent in bot_indicators:
-        if agent in user_agent:
-            return True
-
-    browser_indicators = ('mozilla', 'browser', 'iphone', 'lynx', 'mobile',
-                          'opera', 'icab')
-    has_browser_indicator = False
-    for agent in browser_indicators:
-        if agent in user_agent:
-            has_browser_indicator = True
-            break
-
-    if not has_browser_indicator:
-        return True
+    if self.whitelist.search(user_agent):
+      return False
+    if self.bot.search(user_agent):
+      return True
+    if not self.browser.search(user_agent):
+      return True
 
     # Check for mozilla version information
     if 'mozilla' in user_agent:
-        if '(' not in user_agent:
-            return True
-        if not re.search(r'mozilla/\d+', user_agent):
-            return True
+      if '(' not in user_agent:
+        return True
+      if not _MOZILLA_VERSION.search(user_agent):
+        return True
+    return False
+
+
+class LRUCache(object):
+  # Bounded least-recently-used cache of user-agent -> result. Entries are
+  # [prev, next, key, value] links in a circular list around self._root.
+  def __init__(self, maxsize=10000):
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self._map = {}
+    self._root = root = []
+    root[:] = [root, root, None, None]
+    self._lock = threading.Lock()
+
+  def get(self, key, compute):
+    with self._lock:
+      link = self._map.get(key)
+      if link is not None:
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        root = self._root
+        last = root[0]
+        last[1] = root[0] = link
+        link[0] = last
+        link[1] = root
+        self.hits += 1
+        return link[3]
+      self.misses += 1
+
+    value = compute(key)
+    with self._lock:
+      if key in self._map:
+        return value
+      root = self._root
+      if len(self._map) >= self.maxsize:
+        oldest = root[1]
+        root[1] = oldest[1]
+        oldest[1][0] = root
+        del self._map[oldest[2]]
+      last = root[0]
+      link = [last, root, key, value]
+      last[1] = root[0] = self._map[key] = link
+    return value
+
+  def info(self):
+    return {'hits': self.hits, 'misses': self.misses,
+            'size': len(self._map), 'maxsize': self.maxsize}
+
+  def clear(self):
+    with self._lock:
+      self._map.clear()
+      root = self._root
+      root[:] = [root, root, None, None]
+      self.hits = self.misses = 0
+
+
+class RobotDetector(object):
+  # Lookups read self._state, an (index, cache) pair, exactly once, and a
+  # reload builds a complete new pair before swapping it in. Lookups never
+  # wait for a reload and results from the old signatures never reach the
+  # new cache.
+  def __init__(self, path=SIGNATURES, cache_size=10000):
+    self.path = path
+    self.cache_size = cache_size
+    self._mtime = None
+    self._state = None
+    self._reload_lock = threading.Lock()
+    self.reload()
+
+  @property
+  def signatures(self):
+    return self._state[0].signatures
+
+  def reload(self):
+    with self._reload_lock:
+      mtime = os.path.getmtime(self.path)
+      fh = open(self.path)
+      try:
+        index = SignatureIndex(json.load(fh))
+      finally:
+        fh.close()
+      self._state = (index, LRUCache(self.cache_size))
+      self._mtime = mtime
+
+  def reload_if_changed(self):
+    try:
+      changed = os.path.getmtime(self.path) != self._mtime
+    except OSError:
+      return False
+    if changed:
+      self.reload()
+    return changed
+
+  def watch(self, interval=60):
+    def poll():
+      while True:
+        time.sleep(interval)
+        try:
+          self.reload_if_changed()
+        except (IOError, OSError, ValueError, KeyError):
+          pass  # keep the signatures we have
+    thread = threading.Thread(target=poll, name='km-robot-signatures')
+    thread.daemon = True
+    thread.start()
+    return thread
+
+  def classify(self, user_agent):
+    return self._state[0].classify(user_agent)
+
+  def is_robot(self, user_agent):
+    if not user_agent:
+      return False
+    index, cache = self._state
+    return cache.get(user_agent, index.classify)
+
+  def is_robot_many(self, user_agents):
+    return [self.is_robot(user_agent) for user_agent in user_agents]
+
+  def cache_info(self):
+    return self._state[1].info()
+
+  def cache_clear(self):
+    self._state[1].clear()
+
+
+default_detector = RobotDetector()
+
+
+def classify(user_agent):
+  return default_detector.classify(user_agent)
+
+
+def is_robot(user_agent):
+  return default_detector.is_robot(user_agent)
+
+
+def is_robot_many(user_agents):
+  return default_detector.is_robot_many(user_agents)
+
+
+def cache_info():
+  return default_detector.cache_info()
+
 
-  return False
+def cache_clear():
+  default_detector.cache_clear()
@@ -0,0 +1,261 @@
+"""
+Streaming importer for historical events, run as
+
+    kissmetrics import <your_key> <file.csv|file.jsonl> [options]
+
+Rows are read, mapped to queries and sent through a generator pipeline, so
+memory use does not depend on the size of the input. Mapping and
+serialization can be spread over worker processes, sending goes through
+KM.request_many, and progress is checkpointed so an interrupted import can be
+resumed with the same command.
+"""
+
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import deque
+from itertools import islice
+from optparse import OptionParser
+
+from km import KM
+from km.query import QuerySerializer
+from km.ratelimit import throttle
+
+
+class Source(object):
+    # Iterates the rows of a CSV or JSON-lines file, keeping track of how many
+    # bytes have been consumed so progress can be estimated. A JSON line that
+    # does not parse yields None, which is counted as an invalid row.
+    def __init__(self, path, format=None):
+        self.path = path
+        self.format = format or ('csv' if path.endswith('.csv') else 'jsonl')
+        self.size = os.path.getsize(path)
+        self.consumed = 0
+
+    def _lines(self, fh):
+        for line in fh:
+            self.consumed += len(line)
+            yield line
+
+    def __iter__(self):
+        fh = open(self.path, 'rb')
+        try:
+            lines = self._lines(fh)
+            if self.format == 'csv':
+                for row in csv.DictReader(lines):
+                    yield row
+            else:
+                for line in lines:
+                    if line.strip():
+                        try:
+                            yield json.loads(line)
+                        except ValueError:
+                            yield None
+        finally:
+            fh.close()
+
+
+class Mapping(object):
+    def __init__(self, type='e', identity='_p', name='_n', timestamp='_t'):
+        self.type = type
+        self.identity = identity
+        self.name = name
+        self.timestamp = timestamp
+
+    def data(self, row):
+        """Map a row to (identity, data); raises ValueError if invalid."""
+        data = dict((k, v) for k, v in row.iteritems()
+                    if v is not None and v != '')
+        identity = data.pop(self.identity, None)
+        if identity is None:
+            raise ValueError("missing %s" % self.identity)
+        if self.type == 'e':
+            if self.name not in data:
+                raise ValueError("missing %s" % self.name)
+            data['_n'] = data.pop(self.name)
+        if self.timestamp in data:
+            data['_t'] = int(data.pop(self.timestamp))
+        encoded = {}
+        for name, value in data.iteritems():
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            encoded[name] = value
+        return identity, encoded
+
+
+_worker = {}
+
+
+def _init_worker(key, mapping):
+    _worker['key'] = key
+    _worker['mapping'] = mapping
+    _worker['serializer'] = QuerySerializer()
+
+
+def _serialize(rows):
+    # rows: [(row number, row)] -> [(row number, query line or None)]
+    key = _worker['key']
+    mapping = _worker['mapping']
+    serializer = _worker['serializer']
+    out = []
+    for number, row in rows:
+        try:
+            identity, data = mapping.data(row)
+            if isinstance(identity, unicode):
+                identity = identity.encode('utf-8')
+            line = serializer.line(mapping.type, data, key, identity)
+        except (ValueError, TypeError, AttributeError, UnicodeError):
+            # AttributeError: the row is not an object (or did not parse).
+            out.append((number, None))
+            continue
+        out.append((number, line))
+    return out
+
+
+def serialized(rows, key, mapping, processes=0, chunk_size=500):
+    """Yield (row number, line or None) for rows, in order."""
+    rows = iter(rows)
+    chunks = iter(lambda: list(islice(rows, chunk_size)), [])
+    if processes <= 1:
+        _init_worker(key, mapping)
+        for chunk in chunks:
+            for item in _serialize(chunk):
+                yield item
+        return
+
+    pool = multiprocessing.Pool(processes, _init_worker, (key, mapping))
+    try:
+        # Only a bounded window of chunks is in flight at a time.
+        window = deque()
+        for chunk in chunks:
+            window.append(pool.apply_async(_serialize, (chunk,)))
+            if len(window) >= processes * 2:
+                for item in window.popleft().get():
+                    yield item
+        while window:
+            for item in window.popleft().get():
+                yield item
+    finally:
+        pool.terminate()
+
+
+class Checkpoint(object):
+    def __init__(self, path):
+        self.path = path
+
+    def load(self):
+        if not self.path:
+            return 0
+        try:
+            return int(open(self.path).read())
+        except (IOError, ValueError):
+            return 0
+
+    def save(self, rows):
+        if not self.path:
+            return
+        tmp = self.path + '.tmp'
+        fh = open(tmp, 'w')
+        fh.write(str(rows))
+        fh.close()
+        os.rename(tmp, self.path)
+
+
+class Import(object):
+    def __init__(self, km, source, mapping, processes=0, rate=None,
+                 checkpoint=None, out=sys.stderr):
+        self.km = km
+        self.source = source
+        self.mapping = mapping
+        self.processes = processes
+        self.rate = rate
+        self.checkpoint = Checkpoint(checkpoint)
+        self.out = out
+        self.invalid = 0
+        self.failed = 0
+        self._rows = deque()
+        self._start = None
+
+    def numbered(self, skip):
+        rows = enumerate(self.source, 1)
+        if skip:
+            rows = islice(rows, skip, None)
+        return rows
+
+    def lines(self, skip):
+        items = serialized(self.numbered(skip), self.km._key, self.mapping,
+                           self.processes)
+        for number, line in items:
+            if line is None:
+                self.invalid += 1
+                continue
+            self._rows.append(number)
+            yield line
+
+    def on_batch(self, batch):
+        for i in xrange(batch.end - batch.start - 1):
+            self._rows.popleft()
+        last = self._rows.popleft()
+        # Once anything has failed the checkpoint stays put, so resuming
+        # re-sends from the last batch that fully succeeded.
+        self.failed += batch.failed
+        if not self.failed:
+            self.checkpoint.save(last)
+        self.report(batch.end)
+
+    def report(self, sent):
+        elapsed = time.time() - self._start
+        rate = sent / elapsed if elapsed else 0
+        done = float(self.source.consumed) / (self.source.size or 1)
+        eta = elapsed * (1 - done) / done if done else 0
+        self.out.write("%d events  %.0f/sec  %.1f%%  ETA %dm%02ds\n" % (
+            sent, rate, done * 100, eta // 60, eta % 60))
+
+    def run(self, batch_size=1000, connections=4):
+        self._start = time.time()
+        lines = self.lines(self.checkpoint.load())
+        if self.rate:
+            lines = throttle(lines, self.rate)
+        return self.km.request_many(lines, batch_size, connections,
+                                    self.on_batch)
+
+
+def main(args):
+    parser = OptionParser(usage="%prog import <your_key> <file> [options]")
+    parser.add_option('--host', default='trk.kissmetrics.com:80')
+    parser.add_option('--format', choices=('csv', 'jsonl'),
+                      help="input format (default: from file extension)")
+    parser.add_option('--type', choices=('e', 's'), default='e',
+                      help="e to record events, s to set properties")
+    parser.add_option('--identity-column', default='_p')
+    parser.add_option('--event-column', default='_n')
+    parser.add_option('--time-column', default='_t')
+    parser.add_option('--processes', type='int', default=0,
+                      help="serialize in this many worker processes")
+    parser.add_option('--connections', type='int', default=4)
+    parser.add_option('--batch-size', type='int', default=1000)
+    parser.add_option('--rate', type='float',
+                      help="maximum events per second")
+    parser.add_option('--checkpoint',
+                      help="file recording progress, used to resume")
+    parser.prog = os.path.basename(args[0])
+    options, positional = parser.parse_args(list(args[2:]))
+    if len(positional) != 2:
+        parser.print_usage(sys.stderr)
+        return 1
+    key, path = positional
+
+    mapping = Mapping(options.type, options.identity_column,
+                      options.event_column, options.time_column)
+    job = Import(KM(key, host=options.host), Source(path, options.format),
+                 mapping, options.processes, options.rate, options.checkpoint)
+    sent, failed = job.run(options.batch_size, options.connections)
+    elapsed = time.time() - job._start
+    print "Imported %d events in %.2fs (%.0f/sec), %d failed, %d invalid" % (
+        sent, elapsed, sent / elapsed if elapsed else 0, failed, job.invalid)
+    return 2 if failed else 0
@@ -0,0 +1,205 @@
+"""
+Error logging for KM, built on the stdlib logging module.
+
+Each error log file gets a logger named "km.errors.<path>", so applications
+can also see KM's errors through handlers on the "km" logger. Records go
+through a bounded queue to a single writer thread, which keeps the file open
+and writes in batches, so logging never does file I/O on the caller's thread.
+Repeats of an identical message within `interval` seconds are suppressed and
+counted in the next one that gets through.
+
+Each batch is written with a single write() to a file opened O_APPEND, so
+processes sharing a log file (pre-fork servers) do not interleave lines.
+"""
+
+import atexit
+import logging
+import os
+import threading
+import time
+from Queue import Empty, Full, Queue
+
+from km.forksafe import ForkAware
+
+
+class RepeatFilter(logging.Filter):
+    def __init__(self, interval=60, maxsize=1000):
+        logging.Filter.__init__(self)
+        self.interval = interval
+        self.maxsize = maxsize
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        key = record.getMessage()
+        now = time.time()
+        with self._lock:
+            last, suppressed = self._seen.get(key, (None, 0))
+            if last is not None and now - last < self.interval:
+                self._seen[key] = (last, suppressed + 1)
+                return False
+            if len(self._seen) >= self.maxsize:
+                self._seen.clear()
+            self._seen[key] = (now, 0)
+        if suppressed:
+            record.msg = "%s (%d similar messages suppressed)" % (
+                record.msg, suppressed)
+        return True
+
+
+class BufferedFileHandler(logging.Handler):
+    # Leaves flushing to the QueueListener, which flushes once per batch.
+    def __init__(self, filename):
+        logging.Handler.__init__(self)
+        self.baseFilename = os.path.abspath(filename)
+        self.fd = None
+        self.buffer = []
+
+    def emit(self, record):
+        try:
+            msg = self.format(record)
+            if isinstance(msg, unicode):
+                msg = msg.encode('utf-8')
+            self.buffer.append(msg + '\n')
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            data = ''.join(self.buffer)
+            del self.buffer[:]
+            if data and self.fd is None:
+                self.fd = os.open(self.baseFilename,
+                                  os.O_WRONLY | os.O_APPEND | os.O_CREAT,
+                                  0644)
+            while data:
+                data = data[os.write(self.fd, data):]
+        except (IOError, OSError):
+            pass
+        finally:
+            self.release()
+
+    def reset(self):
+        # After a fork: the parent writes out what it had buffered.
+        self.createLock()
+        self.buffer = []
+
+    def close(self):
+        self.flush()
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        logging.Handler.close(self)
+
+    def handleError(self, record):
+        pass  # just discard at this point
+
+
+class QueueHandler(logging.Handler):
+    def __init__(self, listener):
+        logging.Handler.__init__(self)
+        self.listener = listener
+        self.dropped = 0
+
+    def emit(self, record):
+        # Format now so the record carries no references to caller state.
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        try:
+            self.listener.put(record)
+        except Full:
+            self.dropped += 1
+
+
+class QueueListener(ForkAware):
+    def __init__(self, handler, queue_size=10000):
+        self.handler = handler
+        self.queue_size = queue_size
+        self._start()
+
+    def _start(self):
+        self.queue = Queue(self.queue_size)
+        self._pid = os.getpid()
+        self._thread = threading.Thread(target=self._run,
+                                        name='km-error-log')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while True:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            for record in batch:
+                if record is None:
+                    break
+                self.handler.handle(record)
+            self.handler.flush()
+            # Only now is the batch on disk, which is what flush() waits for.
+            for record in batch:
+                self.queue.task_done()
+            if None in batch:
+                return
+
+    def _after_fork(self):
+        self.handler.reset()
+        self._start()
+
+    def put(self, record):
+        self._check_fork()
+        self.queue.put_nowait(record)
+
+    def flush(self):
+        self._check_fork()
+        self.queue.join()
+
+    def stop(self):
+        self._check_fork()
+        self.queue.put(None)
+        self._thread.join()
+        self.handler.close()
+
+
+_listeners = {}
+_lock = threading.Lock()
+
+
+def error_logger(path, queue_size=10000, interval=60):
+    logger = logging.getLogger('km.errors.' + path)
+    with _lock:
+        if path not in _listeners:
+            handler = BufferedFileHandler(path)
+            formatter = logging.Formatter('<%(asctime)s> %(message)s', '%c')
+            formatter.converter = time.gmtime
+            handler.setFormatter(formatter)
+            listener = QueueListener(handler, queue_size)
+            _listeners[path] = listener
+            logger.addFilter(RepeatFilter(interval))
+            logger.addHandler(QueueHandler(listener))
+    return logger
+
+
+def flush():
+    for listener in _listeners.values():
+        listener.flush()
+
+
+@atexit.register
+def shutdown():
+    with _lock:
+        listeners = _listeners.items()
+        _listeners.clear()
+    for path, listener in listeners:
+        logger = logging.getLogger('km.errors.' + path)
+        for handler in logger.handlers[:]:
+            if isinstance(handler, QueueHandler):
+                logger.removeHandler(handler)
+        for filter in logger.filters[:]:
+            if isinstance(filter, RepeatFilter):
+                logger.removeFilter(filter)
+        listener.stop()
@@ -0,0 +1,123 @@
+"""
+Query serializer used by KM.query_line.
+
+The constant head of each query ("/e?_k=<key>&_p=<identity>") is encoded once
+and cached, quoted property and event names are memoized, and the _t
+timestamp string is only re-formatted when the second changes. A serializer
+is safe to share between threads.
+
+KM builds an Event for each call and encodes it straight into a query line,
+so the caller's props dict is read but never copied or modified.
+"""
+
+import time
+import urllib
+
+quote = urllib.quote
+
+
+class QuerySerializer(object):
+    def __init__(self, clock=time.time, cache_size=4096):
+        self.clock = clock
+        self.cache_size = cache_size
+        self._prefixes = {}
+        self._names = {}
+        self._actions = {}
+        self._stamp = (None, None)
+
+    def _remember(self, cache, key, value):
+        if len(cache) >= self.cache_size:
+            cache.clear()
+        cache[key] = value
+        return value
+
+    def prefix(self, type, key, identity=None, update=True):
+        cache_key = (type, key, update, identity)
+        try:
+            return self._prefixes[cache_key]
+        except KeyError:
+            head = '/' + type + '?_k=' + quote(str(key))
+            if update:
+                head += '&_p=' + quote(str(identity))
+            return self._remember(self._prefixes, cache_key, head)
+
+    def timestamp(self):
+        # (second, string) is swapped as one object so concurrent callers
+        # never pair a new second with a stale string.
+        second = int(self.clock())
+        stamp = self._stamp
+        if stamp[0] != second:
+            stamp = self._stamp = (second, str(second))
+        return stamp[1]
+
+    def line(self, type, data, key, identity=None, update=True):
+        return self.encode(type, key, identity, None, data, None, update)
+
+    def encode(self, type, key, identity, name, props, timestamp=None,
+               update=True):
+        """Build a query line from its parts without copying or changing
+        props. name, if given, is sent as _n; timestamp as _t (with _d=1)."""
+        names = self._names
+        custom_time = timestamp is not None or '_t' in props
+        parts = [self.prefix(type, key, identity, update)]
+        append = parts.append
+        if name is not None:
+            try:
+                append(self._actions[name])
+            except KeyError:
+                append(self._remember(self._actions, name,
+                                      '&_n=' + quote(str(name))))
+            except TypeError:
+                # Unhashable, such as the dict record() also sends as a set.
+                append('&_n=' + quote(str(name)))
+        for prop, val in props.iteritems():
+            if prop == '_k' or (update and prop == '_p') or \
+                    (custom_time and prop == '_d') or \
+                    (name is not None and prop == '_n') or \
+                    (timestamp is not None and prop == '_t'):
+                continue
+            try:
+                append(names[prop])
+            except KeyError:
+                append(self._remember(names, prop,
+                                      '&' + quote(str(prop)) + '='))
+            if val.__class__ is int:
+                append(str(val))
+            else:
+                append(quote(str(val)))
+
+        # if user has defined their own _t, then include necessary _d
+        if timestamp is not None:
+            append('&_t=')
+            if timestamp.__class__ is int:
+                append(str(timestamp))
+            else:
+                append(quote(str(timestamp)))
+        if custom_time:
+            append('&_d=1')
+        else:
+            append('&_t=')
+            append(self.timestamp())
+        return ''.join(parts)
+
+
+class Event(object):
+    # One record/set/alias call, kept as references to the caller's values
+    # (props is never modified) until it is encoded.
+    __slots__ = ('kind', 'identity', 'name', 'timestamp', 'props')
+
+    def __init__(self, kind, identity=None, name=None, props=None,
+                 timestamp=None):
+        self.kind = kind
+        self.identity = identity
+        self.name = name
+        self.props = props if props is not None else EMPTY
+        self.timestamp = timestamp
+
+    def line(self, key, serializer):
+        return serializer.encode(self.kind, key, self.identity, self.name,
+                                 self.props, self.timestamp,
+                                 self.kind != 'a')
+
+
+EMPTY = {}
@@ -0,0 +1,97 @@
+"""
+Token-bucket rate limiting and event sampling.
+"""
+
+import threading
+import time
+import zlib
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst=None, clock=time.time):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self.clock = clock
+        self._tokens = self.burst
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def consume(self, tokens=1):
+        # Take tokens if available; never blocks.
+        with self._lock:
+            self._refill()
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return True
+            return False
+
+    def wait(self, tokens=1):
+        # Block until tokens are available, then take them.
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                delay = (tokens - self._tokens) / self.rate
+            time.sleep(delay)
+
+
+def throttle(iterable, rate):
+    bucket = TokenBucket(rate)
+    for item in iterable:
+        bucket.wait()
+        yield item
+
+
+class EventSampler(object):
+    # Per-event sampling and rate limiting in front of KM.record.
+    #
+    # rates maps event names to the fraction of identities to keep. Sampling
+    # hashes the identity, so a given user is either always or never kept
+    # for an event and their funnels stay intact. Kept events carry the rate
+    # in `property` so counts can be scaled back up.
+    #
+    # limits maps event names to a maximum events/sec for this process;
+    # events over the limit are dropped.
+    def __init__(self, rates=None, default_rate=1.0, limits=None,
+                 property='sample_rate'):
+        self.rates = rates or {}
+        self.default_rate = default_rate
+        self.property = property
+        self.buckets = dict((name, TokenBucket(limit))
+                            for name, limit in (limits or {}).iteritems())
+        self.sampled_out = {}
+        self.rate_limited = {}
+
+    def keep(self, identity, rate):
+        bucket = zlib.crc32(str(identity)) & 0xffffffff
+        return bucket < rate * 0x100000000
+
+    def admit(self, action, identity):
+        """Return the sample rate to record the event with, or None to
+        drop it."""
+        try:
+            rate = self.rates.get(action, self.default_rate)
+        except TypeError:
+            # Unhashable, such as the dict record() also sends as a set.
+            action = str(action)
+            rate = self.rates.get(action, self.default_rate)
+        if rate < 1 and not self.keep(identity, rate):
+            self.sampled_out[action] = self.sampled_out.get(action, 0) + 1
+            return None
+        bucket = self.buckets.get(action)
+        if bucket is not None and not bucket.consume():
+            self.rate_limited[action] = self.rate_limited.get(action, 0) + 1
+            return None
+        return rate
+
+    def stats(self):
+        return {'sampled_out': dict(self.sampled_out),
+                'rate_limited': dict(self.rate_limited)}
@@ -0,0 +1,269 @@
+"""
+Parallel replay of a spool backlog, for catching up after an outage.
+
+Segments are memory-mapped and read in windows of `window` lines. Lines
+that exactly repeat one of the last `dedupe_size` distinct lines (compared
+by SHA-1 digest) and, given a horizon, events whose _t is more than
+`horizon` seconds old are dropped. The rest of each window is split by
+identity (_p) across `workers` threads, each pipelining over its own
+keep-alive connection, so events for one identity keep their order while
+different identities go out in parallel.
+
+The replay holds the spool's sender lock (see Spool.lock_sender) and does
+nothing if another sender holds it.
+
+A segment's offset is checkpointed after every window, so a crashed replay
+resends at most one window. As with Spool.drain, lines the tracker refuses
+with a 4xx are set aside with Spool.reject, lines that still fail are
+appended back to the spool, and a window in which every send fails stops
+the replay at its start. Once a line for an identity has been appended back,
+that identity's later lines are appended after it instead of being sent, so
+they stay in order; from then on a window in which every send fails is
+appended back as well rather than stopping the replay, since stopping would
+let the rest of the backlog overtake what was appended back. (With the
+circuit open these sends fail at once.)
+"""
+
+import mmap
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from hashlib import sha1
+from Queue import Queue
+
+from km.transport import ConnectionPool, permanent
+
+
+class Progress(namedtuple('Progress',
+                          'sent failed duplicates expired seconds')):
+    @property
+    def rate(self):
+        return self.sent / self.seconds if self.seconds else 0.0
+
+
+def _field(line, name):
+    start = line.find('&' + name + '=')
+    if start < 0:
+        return None
+    start += len(name) + 2
+    end = line.find('&', start)
+    return line[start:end] if end >= 0 else line[start:]
+
+
+def _identity(line):
+    return _field(line, '_p') or ''
+
+
+def segment_lines(segment, offset=0):
+    """Yield (line, end_offset) for the complete lines of a segment."""
+    fh = open(segment, 'rb')
+    try:
+        if not os.fstat(fh.fileno()).st_size:
+            return
+        data = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+        fh.close()
+    try:
+        find = data.find
+        while True:
+            end = find('\n', offset)
+            if end < 0:
+                # Missing or torn final write.
+                return
+            yield data[offset:end], end + 1
+            offset = end + 1
+    finally:
+        data.close()
+
+
+class Replay(object):
+    def __init__(self, km, workers=4, horizon=None, dedupe=True, window=10000,
+                 batch_size=100, on_progress=None, clock=time.time,
+                 dedupe_size=100000):
+        self.km = km
+        self.spool = km.spool
+        self.workers = workers
+        self.horizon = horizon
+        self.dedupe = dedupe
+        self.dedupe_size = dedupe_size
+        self.window = window
+        self.batch_size = batch_size
+        self.on_progress = on_progress
+        self.clock = clock
+        self._seen = set()
+        self._recent = deque()
+        # Identities with a line appended back to the spool.
+        self._held = set()
+        self._counts = dict.fromkeys(
+            ('sent', 'failed', 'duplicates', 'expired'), 0)
+
+    def _keep(self, line, oldest):
+        if self.dedupe:
+            digest = sha1(line).digest()
+            if digest in self._seen:
+                self._counts['duplicates'] += 1
+                return False
+            self._seen.add(digest)
+            self._recent.append(digest)
+            if len(self._recent) > self.dedupe_size:
+                self._seen.discard(self._recent.popleft())
+        if oldest is not None:
+            try:
+                timestamp = int(_field(line, '_t'))
+            except (TypeError, ValueError):
+                return True
+            if timestamp < oldest:
+                self._counts['expired'] += 1
+                return False
+        return True
+
+    def _work(self, jobs, done):
+        pool = self.km._pool
+        if isinstance(pool, ConnectionPool):
+            pool = ConnectionPool(maxsize=1, timeout=pool.timeout,
+                                  connect_timeout=pool.connect_timeout,
+                                  retry=pool.retry, resolver=pool.resolver)
+        try:
+            while True:
+                lines = jobs.get()
+                if lines is None:
+                    return
+                failed = []
+                # Identities whose send failed in this job, with the error;
+                # their later lines are held back rather than sent.
+                held = {}
+                try:
+                    for i in range(0, len(lines), self.batch_size):
+                        batch = []
+                        for line in lines[i:i + self.batch_size]:
+                            error = held.get(_identity(line))
+                            if error is None:
+                                batch.append(line)
+                            else:
+                                failed.append((line, error))
+                        if not batch:
+                            continue
+                        errors = self.km.send_queries(batch, pool)
+                        for line, error in zip(batch, errors):
+                            if error is not None:
+                                failed.append((line, error))
+                                if not permanent(error):
+                                    held[_identity(line)] = error
+                except Exception, e:
+                    failed = [(line, e) for line in lines]
+                done.put((len(lines), failed))
+        finally:
+            if pool is not self.km._pool:
+                pool.clear()
+
+    def _send(self, lines, queues, done):
+        # Returns (line, error) for the lines that could not be sent.
+        buckets = [[] for queue in queues]
+        for line in lines:
+            buckets[hash(_identity(line)) % len(buckets)].append(line)
+        busy = 0
+        for queue, bucket in zip(queues, buckets):
+            if bucket:
+                queue.put(bucket)
+                busy += 1
+        failed = []
+        for i in range(busy):
+            failed.extend(done.get()[1])
+        return failed
+
+    def progress(self, start):
+        counts = self._counts
+        return Progress(counts['sent'], counts['failed'],
+                        counts['duplicates'], counts['expired'],
+                        self.clock() - start)
+
+    def run(self):
+        """Replay every spooled line; return a Progress."""
+        start = self.clock()
+        if not self.spool.lock_sender():
+            return self.progress(start)
+        try:
+            self._run(start)
+        finally:
+            self.spool.unlock_sender()
+        return self.progress(start)
+
+    def _run(self, start):
+        oldest = None
+        if self.horizon is not None:
+            oldest = int(start - self.horizon)
+        queues = [Queue() for i in range(self.workers)]
+        done = Queue()
+        threads = []
+        for queue in queues:
+            thread = threading.Thread(target=self._work, args=(queue, done),
+                                      name='km-replay')
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            for segment in self.spool.claim():
+                if not self._replay(segment, oldest, queues, done, start):
+                    break
+                self.spool.finish(segment)
+        finally:
+            for queue in queues:
+                queue.put(None)
+            for thread in threads:
+                thread.join()
+
+    def _replay(self, segment, oldest, queues, done, start):
+        offset = self.spool.offset(segment)
+        lines = segment_lines(segment, offset)
+        while True:
+            window = []
+            end = offset
+            for line, end in lines:
+                if line and self._keep(line, oldest):
+                    window.append(line)
+                    if len(window) >= self.window:
+                        break
+            if not window:
+                if end != offset:
+                    self.spool.checkpoint(segment, end)
+                return True
+            read = window
+            deferred = []
+            if self._held:
+                ready = []
+                for line in window:
+                    if _identity(line) in self._held:
+                        deferred.append(line)
+                    else:
+                        ready.append(line)
+                window = ready
+            failed = []
+            rejected = 0
+            for line, error in self._send(window, queues, done):
+                if permanent(error):
+                    self.spool.reject(line, error)
+                    rejected += 1
+                else:
+                    failed.append(line)
+            # Stopping leaves the rest of the backlog to be sent ahead of
+            # anything already appended back, so once an identity is held
+            # a failed window is appended back too and the replay goes on.
+            if failed and len(failed) == len(window) and not self._held:
+                self._counts['failed'] += len(failed)
+                return False
+            self._counts['failed'] += rejected
+            if failed or deferred:
+                for line in failed:
+                    self._held.add(_identity(line))
+                back = set(failed)
+                back.update(deferred)
+                # In the order they were read.
+                for line in read:
+                    if line in back:
+                        self.spool.append(line)
+            self._counts['sent'] += len(window) - len(failed) - rejected
+            self.spool.checkpoint(segment, end)
+            offset = end
+            if self.on_progress is not None:
+                self.on_progress(self.progress(start))
@@ -0,0 +1,181 @@
+"""
+Cached DNS resolution and multi-address connects for the transport.
+
+Resolver caches getaddrinfo results per (host, port) for `ttl` seconds. Once
+an entry is `refresh` of the way through its life it is re-resolved on a
+background thread while callers keep using the cached addresses, so lookups
+stay off the send path; if a lookup fails the previous addresses are used
+until one succeeds. getaddrinfo does not report record TTLs, so `ttl` should
+be set to match the tracker's DNS.
+
+connect() tries a host's addresses happy-eyeballs style: the next address is
+started if the current one has not connected within `stagger` seconds, and
+the first to connect wins. The resolver is told which address won so later
+connects try it first.
+"""
+
+import errno
+import math
+import os
+import select
+import socket
+import threading
+import time
+
+from km.forksafe import ForkAware
+
+
+def _interleave(addresses):
+    # Alternate address families, keeping getaddrinfo's order within each.
+    families = []
+    by_family = {}
+    for address in addresses:
+        family = address[0]
+        if family not in by_family:
+            families.append(family)
+            by_family[family] = []
+        by_family[family].append(address)
+    ordered = []
+    while any(by_family.values()):
+        for family in families:
+            if by_family[family]:
+                ordered.append(by_family[family].pop(0))
+    return ordered
+
+
+class Resolver(ForkAware):
+    def __init__(self, ttl=300, refresh=0.75, clock=time.time,
+                 getaddrinfo=socket.getaddrinfo):
+        self.ttl = ttl
+        self.refresh = refresh
+        self.clock = clock
+        self.getaddrinfo = getaddrinfo
+        self._cache = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _after_fork(self):
+        # Refresh threads do not survive a fork.
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def _resolve(self, key):
+        addresses = _interleave(self.getaddrinfo(key[0], key[1], 0,
+                                                 socket.SOCK_STREAM))
+        if not addresses:
+            raise socket.gaierror("No addresses for %s:%s" % key)
+        with self._lock:
+            self._cache[key] = (addresses, self.clock())
+        return addresses
+
+    def _refresh(self, key):
+        try:
+            self._resolve(key)
+        except socket.error:
+            pass
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def lookup(self, host, port):
+        """Return getaddrinfo-style address tuples for host:port."""
+        self._check_fork()
+        key = (host, port)
+        entry = self._cache.get(key)
+        if entry is not None:
+            addresses, resolved = entry
+            age = self.clock() - resolved
+            if age < self.ttl:
+                if age >= self.ttl * self.refresh:
+                    with self._lock:
+                        start = key not in self._refreshing
+                        self._refreshing.add(key)
+                    if start:
+                        thread = threading.Thread(target=self._refresh,
+                                                  args=(key,),
+                                                  name='km-resolver')
+                        thread.daemon = True
+                        thread.start()
+                return addresses
+        try:
+            return self._resolve(key)
+        except socket.error:
+            if entry is None:
+                raise
+            return entry[0]
+
+    def prefer(self, host, port, sockaddr):
+        """Move the address that connected to the front of the list."""
+        key = (host, port)
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None or entry[0][0][4] == sockaddr:
+                return
+            addresses = sorted(entry[0], key=lambda a: a[4] != sockaddr)
+            self._cache[key] = (addresses, entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+
+default_resolver = Resolver()
+
+
+def _writable(socks, timeout):
+    # Sockets whose connect has finished, one way or the other. select()
+    # cannot watch descriptors >= FD_SETSIZE, which long-lived workers reach,
+    # so poll() is used wherever it exists.
+    if not hasattr(select, 'poll'):
+        return select.select([], socks, [], timeout)[1]
+    poller = select.poll()
+    by_fd = {}
+    for sock in socks:
+        poller.register(sock, select.POLLOUT)
+        by_fd[sock.fileno()] = sock
+    if timeout is not None:
+        timeout = int(math.ceil(timeout * 1000))
+    return [by_fd[fd] for fd, event in poller.poll(timeout)]
+
+
+def connect(addresses, timeout=None, stagger=0.25):
+    """Connect to the first of addresses (getaddrinfo tuples) to answer;
+    return (socket, sockaddr)."""
+    deadline = time.time() + timeout if timeout is not None else None
+    queue = list(addresses)
+    pending = {}
+    error = None
+    try:
+        while queue or pending:
+            if queue:
+                family, socktype, proto, _, sockaddr = queue.pop(0)
+                sock = socket.socket(family, socktype, proto)
+                sock.setblocking(0)
+                err = sock.connect_ex(sockaddr)
+                if err == 0:
+                    sock.setblocking(1)
+                    return sock, sockaddr
+                if err not in (errno.EINPROGRESS, errno.EWOULDBLOCK):
+                    sock.close()
+                    error = socket.error(err, os.strerror(err))
+                    continue
+                pending[sock] = sockaddr
+            wait = stagger if queue else None
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise socket.timeout("timed out")
+                wait = remaining if wait is None else min(wait, remaining)
+            for sock in _writable(list(pending), wait):
+                sockaddr = pending.pop(sock)
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    sock.setblocking(1)
+                    return sock, sockaddr
+                sock.close()
+                error = socket.error(err, os.strerror(err))
+        raise error or socket.error("No addresses to connect to")
+    finally:
+        for sock in pending:
+            sock.close()
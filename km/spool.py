@@ -0,0 +1,321 @@
+"""
+Durable on-disk query spool used by KM's cron mode.
+
+Queries are appended to kissmetrics_query.log in the spool directory and
+fsync'd in batches. Once the active file grows past segment_bytes it is sealed
+by renaming it to kissmetrics_query.log.<stamp>. A sender claims segments by
+atomically renaming them to kissmetrics_sending.log.<stamp> and records how
+far it got in a .offset file next to each, so a crashed drain resumes where it
+stopped instead of starting over.
+
+Writers and the sender serialise on an flock of the active file, which keeps
+concurrent processes from appending to a segment that has just been claimed.
+Senders exclude each other with an flock of the spool directory itself: a
+drain or replay that finds another one running returns without sending, so
+overlapping cron runs do not send the backlog twice.
+
+Lines the tracker refuses outright (a 4xx) will never be accepted, so rather
+than being resent forever they are set aside in kissmetrics_rejected.log,
+one per line followed by a tab and the error.
+
+With per_process=True each process appends to its own active file,
+kissmetrics_query.log-<pid>, so workers of a pre-fork server never contend
+for the same lock; a single sidecar sender claims and drains them all.
+"""
+
+import errno
+import fcntl
+import os
+import threading
+import time
+
+from km.forksafe import ForkAware
+from km.transport import permanent
+
+QUERY_LOG = 'kissmetrics_query.log'
+SENDING_LOG = 'kissmetrics_sending.log'
+REJECTED_LOG = 'kissmetrics_rejected.log'
+
+
+class Spool(ForkAware):
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024,
+                 fsync_every=100, checkpoint_every=100, per_process=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.fsync_every = fsync_every
+        self.checkpoint_every = checkpoint_every
+        self.per_process = per_process
+        self._fh = None
+        self._unsynced = 0
+        self._seq = 0
+        self._sender = None
+        # flock does not exclude threads sharing our file descriptor.
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _after_fork(self):
+        # An inherited descriptor shares its flock with the parent, so the
+        # child must open its own. Writes are flushed as they are made, so
+        # there is nothing buffered to lose.
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        self._unsynced = 0
+        self._lock = threading.Lock()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def active(self):
+        if self.per_process:
+            return self.path('%s-%d' % (QUERY_LOG, self._pid))
+        return self.path(QUERY_LOG)
+
+    def _stamp(self):
+        self._seq += 1
+        return '%016d-%d-%d' % (time.time() * 1000, os.getpid(), self._seq)
+
+    def _open(self):
+        self._fh = open(self.active(), 'a')
+        self._unsynced = 0
+
+    def _lock_current(self):
+        # Returns with the lock held on a file that is still the active
+        # segment; reopens if a sender renamed ours away in the meantime.
+        while True:
+            if self._fh is None:
+                self._open()
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_EX)
+            try:
+                current = os.stat(self.active()).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(self._fh.fileno()).st_ino:
+                return
+            fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+            self._fh.close()
+            self._fh = None
+
+    def append(self, line):
+        self._check_fork()
+        with self._lock:
+            self._lock_current()
+            try:
+                self._fh.write(line + '\n')
+                self._fh.flush()
+                self._unsynced += 1
+                if self._unsynced >= self.fsync_every:
+                    os.fsync(self._fh.fileno())
+                    self._unsynced = 0
+                if self._fh.tell() >= self.segment_bytes:
+                    self._seal()
+            finally:
+                if self._fh is not None:
+                    fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+
+    def _seal(self):
+        os.fsync(self._fh.fileno())
+        os.rename(self.active(), self.path(QUERY_LOG + '.' + self._stamp()))
+        fcntl.flock(self._fh.fileno(), fcntl.LOCK_UN)
+        self._fh.close()
+        self._fh = None
+
+    def sync(self):
+        self._check_fork()
+        with self._lock:
+            if self._fh is not None and self._unsynced:
+                os.fsync(self._fh.fileno())
+                self._unsynced = 0
+
+    def close(self):
+        self.sync()
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def claim(self):
+        """Rename every query segment to a sending segment and return all
+        sending segments, oldest first, including ones left by a crash."""
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        active = [QUERY_LOG]
+        for name in sorted(names):
+            if name.startswith(QUERY_LOG + '.'):
+                stamp = name[len(QUERY_LOG) + 1:]
+                os.rename(self.path(name),
+                          self.path(SENDING_LOG + '.' + stamp))
+            elif name.startswith(QUERY_LOG + '-'):
+                active.append(name)
+
+        for name in active:
+            try:
+                fh = open(self.path(name), 'r')
+            except IOError:
+                continue
+            try:
+                fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+                if os.fstat(fh.fileno()).st_size:
+                    os.rename(self.path(name),
+                              self.path(SENDING_LOG + '.' + self._stamp()))
+                elif name != QUERY_LOG:
+                    # Left behind by a worker that has since exited.
+                    os.unlink(self.path(name))
+            finally:
+                fh.close()
+
+        return sorted(self.path(name) for name in os.listdir(self.directory)
+                      if name.startswith(SENDING_LOG + '.') and
+                      not name.endswith(('.offset', '.offset.tmp')))
+
+    def offset(self, segment):
+        try:
+            return int(open(segment + '.offset').read())
+        except (IOError, ValueError):
+            return 0
+
+    def checkpoint(self, segment, offset):
+        tmp = segment + '.offset.tmp'
+        fh = open(tmp, 'w')
+        fh.write(str(offset))
+        fh.close()
+        os.rename(tmp, segment + '.offset')
+
+    def segment_lines(self, segment):
+        """Yield (line, end_offset) for the unsent lines of a segment."""
+        fh = open(segment, 'r')
+        try:
+            fh.seek(self.offset(segment))
+            while True:
+                line = fh.readline()
+                if not line.endswith('\n'):
+                    # Missing or torn final write.
+                    return
+                yield line[:-1], fh.tell()
+        finally:
+            fh.close()
+
+    def reject(self, line, error):
+        """Set aside a line the tracker refused, so it is not resent."""
+        fh = open(self.path(REJECTED_LOG), 'a')
+        try:
+            fh.write('%s\t%s\n' % (line, error))
+        finally:
+            fh.close()
+
+    def finish(self, segment):
+        for path in (segment, segment + '.offset'):
+            try:
+                os.unlink(path)
+            except OSError, e:
+                if e.errno != errno.ENOENT:
+                    raise
+
+    def lock_sender(self):
+        """Take the sender lock without waiting; return False if another
+        sender holds it."""
+        try:
+            fd = os.open(self.directory, os.O_RDONLY)
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                # No spool directory, so nothing to send.
+                return True
+            raise
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+        self._sender = fd
+        return True
+
+    def unlock_sender(self):
+        if self._sender is not None:
+            os.close(self._sender)
+            self._sender = None
+
+    def drain(self, send=None, send_batch=None, batch_size=100):
+        """Send every spooled line with send(line). Stops at the first
+        failure, leaving the rest for the next run. Returns (sent, failed).
+        Lines refused with a 4xx are passed to reject() and skipped.
+
+        With send_batch(lines), which returns an error or None for each
+        line, lines go out batch_size at a time. Lines that still fail are
+        appended back to the spool for the next run, unless the whole batch
+        failed, in which case the drain stops there.
+
+        Returns (0, 0) at once if another sender is draining the spool."""
+        if not self.lock_sender():
+            return 0, 0
+        try:
+            if send_batch is not None:
+                return self._drain_batches(send_batch, batch_size)
+            return self._drain(send)
+        finally:
+            self.unlock_sender()
+
+    def _drain(self, send):
+        sent = 0
+        for segment in self.claim():
+            offset = None
+            try:
+                for line, offset in self.segment_lines(segment):
+                    if line:
+                        try:
+                            send(line)
+                        except Exception, e:
+                            if not permanent(e):
+                                raise
+                            self.reject(line, e)
+                            continue
+                        sent += 1
+                        if sent % self.checkpoint_every == 0:
+                            self.checkpoint(segment, offset)
+            except Exception:
+                if offset is not None:
+                    # offset is past the failed line; checkpoint before it.
+                    self.checkpoint(segment, offset - len(line) - 1)
+                return sent, 1
+            self.finish(segment)
+        return sent, 0
+
+    def _drain_batches(self, send_batch, batch_size):
+        sent = 0
+        for segment in self.claim():
+            start = self.offset(segment)
+            batch = []
+            lines = self.segment_lines(segment)
+            while True:
+                for line, offset in lines:
+                    if line:
+                        batch.append(line)
+                        if len(batch) >= batch_size:
+                            break
+                else:
+                    offset = None
+                if batch:
+                    errors = send_batch(batch)
+                    failed = []
+                    for line, error in zip(batch, errors):
+                        if error is None:
+                            sent += 1
+                        elif permanent(error):
+                            self.reject(line, error)
+                        else:
+                            failed.append(line)
+                    if failed and len(failed) == len(batch):
+                        self.checkpoint(segment, start)
+                        return sent, 1
+                    for line in failed:
+                        self.append(line)
+                    batch = []
+                if offset is None:
+                    break
+                self.checkpoint(segment, offset)
+                start = offset
+            self.finish(segment)
+        return sent, 0
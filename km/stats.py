@@ -0,0 +1,71 @@
+"""
+Counters and latency histograms behind KM.stats().
+
+Both are updated under a lock on every send, which costs well under a
+microsecond; snapshots are plain dicts that are safe to serialise.
+"""
+
+import threading
+from bisect import bisect_left
+
+
+class Counters(object):
+    def __init__(self, *names):
+        self._counts = dict.fromkeys(names, 0)
+        self._lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def __getitem__(self, name):
+        return self._counts[name]
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+
+class Histogram(object):
+    # Upper bounds of the buckets, in seconds; the last bucket is unbounded.
+    BOUNDS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+              0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, bounds=BOUNDS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        i = bisect_left(self.bounds, seconds)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += seconds
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the given fraction of samples,
+        or None if there are no samples (or it is in the unbounded one)."""
+        with self._lock:
+            counts = list(self.counts)
+            count = self.count
+        if not count:
+            return None
+        rank = fraction * count
+        seen = 0
+        for bound, n in zip(self.bounds, counts):
+            seen += n
+            if seen >= rank:
+                return bound
+        return None
+
+    def snapshot(self):
+        with self._lock:
+            counts = list(self.counts)
+            count, total = self.count, self.sum
+        return {'count': count, 'sum': total,
+                'mean': total / count if count else None,
+                'p50': self.percentile(0.5), 'p99': self.percentile(0.99),
+                'buckets': zip(self.bounds + (None,), counts)}
@@ -0,0 +1,136 @@
+"""
+Stand-ins for the tracker, for testing code that uses KM without a network.
+
+RecordingTransport is passed to KM in place of its connection pool and keeps
+every query in memory:
+
+km = KM('key', pool=RecordingTransport())
+km.identify('bob')
+km.record('Signed Up', {'plan': 'pro'})
+km._pool.events  # [{'_n': 'Signed Up', '_p': 'bob', '_k': 'key', ...}]
+
+LoopbackServer is a real HTTP server on a local port, for exercising the
+whole network path:
+
+with LoopbackServer() as server:
+    km = KM('key', host=server.host)
+    ...
+    server.events
+
+Both accept every wire format in km.encoding: POSTed batches are unpacked
+into the same query lines a GET would carry.
+
+Queries are parsed only when read, so recording stays cheap enough for
+load tests of hundreds of thousands of events.
+"""
+
+import threading
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+from km.encoding import decode, decode_body, parse_query
+from km.transport import HTTPStatusError, Transport
+
+
+class Recorder(object):
+    # Shared by both stand-ins: self.lines holds the raw query lines.
+    @property
+    def queries(self):
+        return [parse_query(line) for line in list(self.lines)]
+
+    def _of_type(self, type):
+        return [params for t, params in self.queries if t == type]
+
+    @property
+    def events(self):
+        return self._of_type('e')
+
+    @property
+    def sets(self):
+        return self._of_type('s')
+
+    @property
+    def aliases(self):
+        return self._of_type('a')
+
+    def reset(self):
+        del self.lines[:]
+
+
+class RecordingTransport(Recorder, Transport):
+    def __init__(self, status=200):
+        self.status = status
+        self.lines = []
+        self.requests = 0
+
+    def send(self, host, data):
+        if not 200 <= self.status < 300:
+            raise HTTPStatusError(self.status, host)
+        self.requests += 1
+        self.lines.extend(decode(data))
+        return self.status
+
+    def stats(self):
+        return {'requests': self.requests}
+
+    def reset(self):
+        Recorder.reset(self)
+        self.requests = 0
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    wbufsize = -1
+
+    def do_GET(self):
+        owner = self.server.owner
+        if owner.record:
+            owner.lines.append(self.path)
+        self._respond()
+
+    def do_POST(self):
+        owner = self.server.owner
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if owner.record:
+            headers = dict((name, self.headers[name])
+                           for name in self.headers)
+            owner.lines.extend(decode_body(headers, body))
+        self._respond()
+
+    def _respond(self):
+        self.send_response(self.server.owner.status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class LoopbackServer(Recorder):
+    def __init__(self, status=200, record=True):
+        self.status = status
+        self.record = record
+        self.lines = []
+        self._server = _Server(('127.0.0.1', 0), _Handler)
+        self._server.owner = self
+        self.host = '127.0.0.1:%d' % self._server.server_address[1]
+        thread = threading.Thread(target=self._server.serve_forever,
+                                  name='km-loopback')
+        thread.daemon = True
+        thread.start()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
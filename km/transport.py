@@ -0,0 +1,475 @@
+"""
+Keep-alive HTTP/1.1 transport used by KM.request.
+
+Connections are pooled per "host:port" string and reused across calls; a
+connection the server has closed underneath us is detected on the next send
+and transparently replaced.
+
+Failed sends (socket errors and 5xx responses) are retried with jittered
+exponential backoff. Each host has a circuit breaker: after
+failure_threshold consecutive failed sends it opens and sends fail fast with
+CircuitOpenError until reset_timeout has passed, when a single probe request
+is let through to decide whether to close it again.
+
+pipeline() writes a window of requests back-to-back on one connection and
+then reads their responses in order. Requests left unanswered when the
+connection drops, or answered with a 5xx, are retried as above; delivery is
+at-least-once, since the server may have acted on a request whose response
+never arrived.
+
+New connections resolve the host through a km.resolver.Resolver, which
+caches lookups and falls back across the host's addresses.
+
+KM sends through any Transport passed as `pool`; km.testing provides an
+in-memory one for tests.
+"""
+
+import errno
+import os
+import random
+import socket
+import threading
+import time
+
+from km.forksafe import ForkAware
+from km.resolver import connect, default_resolver
+
+
+class TransportError(Exception):
+    pass
+
+
+class HTTPStatusError(TransportError):
+    def __init__(self, status, host):
+        TransportError.__init__(self, "HTTP %d from %s" % (status, host))
+        self.status = status
+
+
+class CircuitOpenError(TransportError):
+    pass
+
+
+class ConnectionClosedError(TransportError):
+    pass
+
+
+# Errors on a pooled connection that mean the server closed it while it sat
+# idle, as opposed to a slow or unreachable server; only these are resent at
+# once on a fresh connection.
+_STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE, errno.ECONNABORTED)
+
+
+def permanent(error):
+    """True if resending will not help: the tracker refused the request."""
+    return isinstance(error, HTTPStatusError) and error.status < 500
+
+
+def _stale(error):
+    if isinstance(error, ConnectionClosedError):
+        return True
+    return (isinstance(error, socket.error) and
+            not isinstance(error, socket.timeout) and
+            error.errno in _STALE_ERRNOS)
+
+
+class RetryPolicy(object):
+    def __init__(self, retries=2, backoff=0.05, max_backoff=1.0):
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delays(self):
+        # "Full jitter": a random delay up to the exponential backoff.
+        for attempt in range(self.retries):
+            yield random.uniform(0, min(self.max_backoff,
+                                        self.backoff * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30,
+                 clock=time.time):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = self.CLOSED
+        self.failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if (self.state == self.OPEN and
+                    self.clock() - self._opened_at >= self.reset_timeout):
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == self.HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                self.state = self.OPEN
+                self._opened_at = self.clock()
+
+
+class Transport(object):
+    def send(self, host, data):
+        """Send one raw HTTP request to host ("name:port") and return the
+        response status; raise TransportError if it was not a 2xx."""
+        raise NotImplementedError
+
+    def pipeline(self, host, requests, depth=50):
+        """Send several requests; return a list holding None for each one
+        that was delivered and the exception for each one that was not."""
+        results = []
+        for data in requests:
+            try:
+                self.send(host, data)
+            except Exception, e:
+                results.append(e)
+            else:
+                results.append(None)
+        return results
+
+    def stats(self):
+        return {}
+
+    def warmup(self, host, connections=1):
+        return 0
+
+    def clear(self):
+        pass
+
+
+class Connection(object):
+    def __init__(self, host, port, timeout=None, connect_timeout=None,
+                 resolver=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout or timeout
+        self.resolver = resolver
+        self.sock = None
+        self._buf = ''
+
+    def connect(self):
+        if self.resolver is None:
+            self.sock = socket.create_connection((self.host, self.port),
+                                                 self.connect_timeout)
+        else:
+            self.sock, sockaddr = connect(
+                self.resolver.lookup(self.host, self.port),
+                self.connect_timeout)
+            self.resolver.prefer(self.host, self.port, sockaddr)
+        self.sock.settimeout(self.timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._buf = ''
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+        self.sock = None
+        self._buf = ''
+
+    def _recv(self):
+        chunk = self.sock.recv(8192)
+        if not chunk:
+            raise ConnectionClosedError("Connection closed by " + self.host)
+        self._buf += chunk
+
+    def _read_until(self, marker):
+        while True:
+            pos = self._buf.find(marker)
+            if pos >= 0:
+                data = self._buf[:pos]
+                self._buf = self._buf[pos + len(marker):]
+                return data
+            self._recv()
+
+    def _read_exactly(self, size):
+        while len(self._buf) < size:
+            self._recv()
+        data = self._buf[:size]
+        self._buf = self._buf[size:]
+        return data
+
+    def read_response(self):
+        head = self._read_until('\r\n\r\n')
+        lines = head.split('\r\n')
+        try:
+            version, status = lines[0].split(' ', 2)[:2]
+            status = int(status)
+        except ValueError:
+            raise TransportError("Malformed status line: %r" % lines[0])
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            while True:
+                size = int(self._read_until('\r\n').split(';')[0], 16)
+                self._read_exactly(size + 2)
+                if size == 0:
+                    break
+        elif 'content-length' in headers:
+            self._read_exactly(int(headers['content-length']))
+
+        keep_alive = (version == 'HTTP/1.1' and
+                      headers.get('connection', '').lower() != 'close')
+        return status, keep_alive
+
+    def write(self, data):
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(data)
+
+    def request(self, data):
+        self.write(data)
+        return self.read_response()
+
+
+class ConnectionPool(ForkAware, Transport):
+    def __init__(self, maxsize=4, timeout=5, connect_timeout=None,
+                 retry=None, failure_threshold=5, reset_timeout=30,
+                 resolver=None):
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retry = retry or RetryPolicy()
+        self.resolver = resolver or default_resolver
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.requests = 0
+        self.reused = 0
+        self.connections = 0
+        self.retries = 0
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._breakers = {}
+        self._pid = os.getpid()
+
+    def _after_fork(self):
+        # The idle sockets are shared with the parent; close our copies.
+        idle = self._idle
+        self._lock = threading.Lock()
+        self._idle = {}
+        self._breakers = {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    def stats(self):
+        with self._lock:
+            idle = sum(len(conns) for conns in self._idle.values())
+            open_circuits = sum(1 for breaker in self._breakers.values()
+                                if breaker.state != CircuitBreaker.CLOSED)
+        return {'requests': self.requests, 'reused': self.reused,
+                'connections': self.connections, 'retries': self.retries,
+                'reuse_ratio': (float(self.reused) / self.requests
+                                if self.requests else 0.0),
+                'idle': idle, 'open_circuits': open_circuits}
+
+    def _get(self, host):
+        with self._lock:
+            self.requests += 1
+            idle = self._idle.get(host)
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.connections += 1
+        return self._connection(host), False
+
+    def _connection(self, host):
+        name, port = host.split(':')
+        return Connection(name, int(port), self.timeout,
+                          self.connect_timeout, self.resolver)
+
+    def warmup(self, host, connections=1):
+        """Resolve host and open up to `connections` idle connections to
+        it, so the first sends do not pay for DNS and the handshake.
+        Returns how many were opened."""
+        self._check_fork()
+        with self._lock:
+            idle = len(self._idle.get(host, ()))
+        opened = 0
+        for i in range(min(connections, self.maxsize) - idle):
+            conn = self._connection(host)
+            conn.connect()
+            with self._lock:
+                self.connections += 1
+            self._put(host, conn)
+            opened += 1
+        return opened
+
+    def _put(self, host, conn):
+        with self._lock:
+            idle = self._idle.setdefault(host, [])
+            if len(idle) < self.maxsize:
+                idle.append(conn)
+                return
+        conn.close()
+
+    def breaker(self, host):
+        with self._lock:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(
+                    self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def send(self, host, data):
+        self._check_fork()
+        breaker = self.breaker(host)
+        if not breaker.allow():
+            raise CircuitOpenError("Circuit open for " + host)
+        delays = self.retry.delays()
+        while True:
+            try:
+                status = self._send_once(host, data)
+            except HTTPStatusError, e:
+                if e.status < 500:
+                    # The host is up; the request itself was refused.
+                    breaker.success()
+                    raise
+                error = e
+            except (socket.error, TransportError), e:
+                error = e
+            except Exception:
+                breaker.failure()
+                raise
+            else:
+                breaker.success()
+                return status
+            try:
+                delay = next(delays)
+            except StopIteration:
+                breaker.failure()
+                raise error
+            self.retries += 1
+            time.sleep(delay)
+
+    def _send_once(self, host, data):
+        conn, reused = self._get(host)
+        try:
+            try:
+                status, keep_alive = conn.request(data)
+            except (socket.error, TransportError), e:
+                # A pooled socket may have been closed by the server while
+                # idle; retry once on a fresh connection.
+                if not reused or not _stale(e):
+                    raise
+                conn.close()
+                with self._lock:
+                    self.connections += 1
+                status, keep_alive = conn.request(data)
+        except:
+            conn.close()
+            raise
+
+        if keep_alive:
+            self._put(host, conn)
+        else:
+            conn.close()
+        if not 200 <= status < 300:
+            raise HTTPStatusError(status, host)
+        return status
+
+    def pipeline(self, host, requests, depth=50):
+        # depth bounds how much is written before responses are read, so
+        # neither side's socket buffers can fill up and stall the other.
+        self._check_fork()
+        breaker = self.breaker(host)
+        results = [None] * len(requests)
+        pending = range(len(requests))
+        delays = self.retry.delays()
+        while True:
+            if not breaker.allow():
+                error = CircuitOpenError("Circuit open for " + host)
+                for i in pending:
+                    results[i] = error
+                return results
+            failed = []
+            for start in range(0, len(pending), depth):
+                window = pending[start:start + depth]
+                statuses, error = self._pipeline_once(
+                    host, [requests[i] for i in window])
+                # A window answered only with 5xx counts against the host,
+                # as a 5xx does for send().
+                if any(status < 500 for status in statuses):
+                    breaker.success()
+                elif statuses or error is not None:
+                    breaker.failure()
+                for i, status in zip(window, statuses):
+                    if 200 <= status < 300:
+                        results[i] = None
+                    else:
+                        results[i] = HTTPStatusError(status, host)
+                        if status >= 500:
+                            failed.append(i)
+                for i in window[len(statuses):]:
+                    results[i] = error
+                    failed.append(i)
+            if not failed:
+                return results
+            try:
+                delay = next(delays)
+            except StopIteration:
+                return results
+            with self._lock:
+                self.retries += len(failed)
+            time.sleep(delay)
+            pending = failed
+
+    def _pipeline_once(self, host, batch):
+        # Returns the statuses of the leading requests that got a response,
+        # and the error that stopped the rest, if any.
+        conn, reused = self._get(host)
+        statuses = []
+        keep_alive = True
+        try:
+            conn.write(''.join(batch))
+            with self._lock:
+                # All but the first request ride on an open connection.
+                self.requests += len(batch) - 1
+                self.reused += len(batch) - 1
+            while len(statuses) < len(batch) and keep_alive:
+                status, keep_alive = conn.read_response()
+                statuses.append(status)
+        except (socket.error, TransportError), e:
+            conn.close()
+            if reused and not statuses and _stale(e):
+                # Stale pooled connection; start over on a fresh one.
+                return self._pipeline_once(host, batch)
+            return statuses, e
+        if keep_alive:
+            self._put(host, conn)
+        else:
+            conn.close()
+        if len(statuses) < len(batch):
+            return statuses, ConnectionClosedError("Connection closed by " +
+                                                   host)
+        return statuses, None
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+
+default_pool = ConnectionPool()
@@ -5,6 +5,7 @@ setup(
     name = "gcKISSmetrics",
     version = "1.0.3",
     packages = find_packages(),
+    package_data = {'km.helpers': ['robot_signatures.json']},
 
     # metadata for upload to PyPI
     author = 'KISSmetrics',
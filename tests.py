@@ -6,7 +6,10 @@ from cStringIO import StringIO
 import errno
 import os
 import shutil
+import socket
 import sys
+import threading
+import time
 import unittest
 import urllib
 import urllib2
@@ -16,6 +19,8 @@ from mocker import Mocker
 
 import km
 from km import KM
+from km import main as km_main
+from km.transport import ConnectionPool, RetryPolicy
 
 
 class TestCase(unittest.TestCase):
@@ -364,6 +369,1305 @@ class TestUtils(TestCase):
                 self.assertTrue(KM.is_initialized())
 
 
+class Responder(object):
+    # Minimal keep-alive HTTP server that closes each connection after
+    # `per_conn` responses.
+    def __init__(self, per_conn=None, status=200):
+        self.per_conn = per_conn
+        self.status = status
+        self.connections = 0
+        self.requests = []
+        self.listener = socket.socket()
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(5)
+        self.host = '127.0.0.1:%d' % self.listener.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            conn = self.listener.accept()[0]
+            self.connections += 1
+            thread = threading.Thread(target=self.handle, args=(conn,))
+            thread.daemon = True
+            thread.start()
+
+    def handle(self, conn):
+        buf = ''
+        served = 0
+        while self.per_conn is None or served < self.per_conn:
+            while '\r\n\r\n' not in buf:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                buf += chunk
+            if '\r\n\r\n' not in buf:
+                break
+            head, buf = buf.split('\r\n\r\n', 1)
+            self.requests.append(head)
+            conn.sendall('HTTP/1.1 %d OK\r\nContent-Length: 2\r\n\r\nok'
+                         % self.status)
+            served += 1
+        conn.close()
+
+
+class TestTransport(unittest.TestCase):
+    def test_reuses_connection(self):
+        from km.transport import ConnectionPool
+        server = Responder()
+        pool = ConnectionPool()
+        for i in range(3):
+            self.assertEqual(pool.send(server.host, 'GET /e HTTP/1.1\r\n\r\n'),
+                             200)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual(len(server.requests), 3)
+        pool.clear()
+
+    def test_reconnects_stale_connection(self):
+        from km.transport import ConnectionPool
+        server = Responder(per_conn=1)
+        pool = ConnectionPool()
+        pool.send(server.host, 'GET /e HTTP/1.1\r\n\r\n')
+        pool.send(server.host, 'GET /e HTTP/1.1\r\n\r\n')
+        self.assertEqual(server.connections, 2)
+        pool.clear()
+
+    def test_timeout_not_resent(self):
+        # A reused connection that times out is not treated as stale.
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        host = '127.0.0.1:%d' % listener.getsockname()[1]
+        pool = ConnectionPool(timeout=0.2, retry=RetryPolicy(retries=0))
+        pool.warmup(host)
+        start = time.time()
+        self.assertRaises(socket.timeout, pool.send, host,
+                          'GET /e HTTP/1.1\r\n\r\n')
+        self.assertTrue(time.time() - start < 0.35)
+        self.assertEqual(pool.stats()['connections'], 1)
+        pool.clear()
+        listener.close()
+
+    def test_error_status(self):
+        from km.transport import ConnectionPool, TransportError
+        server = Responder(status=500)
+        pool = ConnectionPool()
+        self.assertRaises(TransportError, pool.send, server.host,
+                          'GET /e HTTP/1.1\r\n\r\n')
+        pool.clear()
+
+
+class TestPipeline(unittest.TestCase):
+    def test_pipeline(self):
+        server = Responder()
+        pool = ConnectionPool()
+        requests = ['GET /e?i=%d HTTP/1.1\r\n\r\n' % i for i in range(5)]
+        self.assertEqual(pool.pipeline(server.host, requests, depth=3),
+                         [None] * 5)
+        self.assertEqual(server.connections, 1)
+        self.assertEqual([request.split()[1] for request in server.requests],
+                         ['/e?i=%d' % i for i in range(5)])
+        pool.clear()
+
+    def test_requeues_unanswered(self):
+        server = Responder(per_conn=2)
+        pool = ConnectionPool(retry=RetryPolicy(backoff=0))
+        requests = ['GET /e?i=%d HTTP/1.1\r\n\r\n' % i for i in range(5)]
+        self.assertEqual(pool.pipeline(server.host, requests), [None] * 5)
+        self.assertEqual(server.connections, 3)
+        pool.clear()
+
+    def test_errors(self):
+        from km.transport import HTTPStatusError
+        server = Responder(status=500)
+        pool = ConnectionPool(retry=RetryPolicy(backoff=0))
+        errors = pool.pipeline(server.host, ['GET /e HTTP/1.1\r\n\r\n'] * 2)
+        self.assertEqual([type(error) for error in errors],
+                         [HTTPStatusError] * 2)
+        self.assertEqual(len(server.requests), 6)
+        pool.clear()
+
+    def test_drain_requeues_failures(self):
+        from km.spool import Spool
+        with LogDir() as log_dir:
+            spool = Spool(log_dir)
+            for i in range(5):
+                spool.append('/e?i=%d' % i)
+            sent = []
+            def send_batch(lines):
+                errors = []
+                for line in lines:
+                    if line == '/e?i=1' and line not in sent:
+                        sent.append(line)  # fail it once
+                        errors.append(IOError('down'))
+                    else:
+                        errors.append(None)
+                return errors
+            self.assertEqual(spool.drain(send_batch=send_batch, batch_size=2),
+                             (4, 0))
+            self.assertEqual(spool.drain(send_batch=send_batch), (1, 0))
+            self.assertEqual(spool.drain(send_batch=send_batch), (0, 0))
+
+    def test_drain_stops_when_down(self):
+        from km.spool import Spool
+        with LogDir() as log_dir:
+            spool = Spool(log_dir)
+            for i in range(5):
+                spool.append('/e?i=%d' % i)
+            ok = lambda lines: [None] * len(lines)
+            down = lambda lines: [IOError('down')] * len(lines)
+            self.assertEqual(spool.drain(send_batch=down), (0, 1))
+            self.assertEqual(spool.drain(send_batch=ok), (5, 0))
+
+    def test_drain_rejects_refused_lines(self):
+        from km.spool import REJECTED_LOG, Spool
+        from km.transport import HTTPStatusError
+        refused = HTTPStatusError(400, 'host')
+        with LogDir() as log_dir:
+            spool = Spool(log_dir)
+            for i in range(4):
+                spool.append('/e?i=%d' % i)
+            refuse = lambda lines: [refused if line < '/e?i=2' else None
+                                    for line in lines]
+            self.assertEqual(spool.drain(send_batch=refuse, batch_size=2),
+                             (2, 0))
+            spool.append('/e?i=4')
+            def send(line):
+                raise refused
+            self.assertEqual(spool.drain(send), (0, 0))
+            self.assertEqual(os.listdir(log_dir), [REJECTED_LOG])
+            self.assertEqual(
+                [line.split('\t')[0] for line
+                 in open(os.path.join(log_dir, REJECTED_LOG))],
+                ['/e?i=0', '/e?i=1', '/e?i=4'])
+
+    def test_5xx_opens_circuit(self):
+        server = Responder(status=503)
+        pool = ConnectionPool(retry=RetryPolicy(retries=0),
+                              failure_threshold=1)
+        pool.pipeline(server.host, ['GET /e HTTP/1.1\r\n\r\n'] * 2)
+        self.assertEqual(pool.stats()['open_circuits'], 1)
+        pool.clear()
+
+
+class TestResolver(unittest.TestCase):
+    def test_cache(self):
+        from km.resolver import Resolver
+        calls = []
+        def getaddrinfo(host, port, family, socktype):
+            calls.append(host)
+            if len(calls) > 2:
+                raise socket.gaierror('down')
+            return [(socket.AF_INET, socktype, 6, '', ('127.0.0.1', port))]
+        now = [0]
+        resolver = Resolver(ttl=100, clock=lambda: now[0],
+                            getaddrinfo=getaddrinfo)
+        address = resolver.lookup('tracker', 80)
+        self.assertEqual(address[0][4], ('127.0.0.1', 80))
+        self.assertEqual(resolver.lookup('tracker', 80), address)
+        self.assertEqual(len(calls), 1)
+        now[0] = 80  # refreshed in the background
+        self.assertEqual(resolver.lookup('tracker', 80), address)
+        for i in range(100):
+            if len(calls) == 2 and not resolver._refreshing:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(calls), 2)
+        now[0] = 500  # expired, and the lookup fails: keep the old address
+        self.assertEqual(resolver.lookup('tracker', 80), address)
+
+    def test_connect_falls_back(self):
+        from km.resolver import Resolver, connect
+        server = Responder()
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        dead = closed.getsockname()
+        closed.close()
+        port = int(server.host.split(':')[1])
+        addresses = [(socket.AF_INET, socket.SOCK_STREAM, 6, '', dead),
+                     (socket.AF_INET, socket.SOCK_STREAM, 6, '',
+                      ('127.0.0.1', port))]
+        sock, sockaddr = connect(addresses, timeout=5)
+        self.assertEqual(sockaddr, ('127.0.0.1', port))
+        sock.close()
+
+        resolver = Resolver(getaddrinfo=lambda *args: addresses)
+        resolver.lookup('tracker', port)
+        resolver.prefer('tracker', port, ('127.0.0.1', port))
+        self.assertEqual(resolver.lookup('tracker', port)[0][4],
+                         ('127.0.0.1', port))
+
+    def test_connect_high_descriptors(self):
+        import resource
+        from km.resolver import _writable, connect
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if hard != resource.RLIM_INFINITY and hard < 1100:
+            return
+        resource.setrlimit(resource.RLIMIT_NOFILE, (max(soft, 1100), hard))
+        server = Responder()
+        port = int(server.host.split(':')[1])
+        filler = []
+        try:
+            while not filler or filler[-1] < 1024:
+                filler.append(os.open(os.devnull, os.O_RDONLY))
+            sock, sockaddr = connect([(socket.AF_INET, socket.SOCK_STREAM, 6,
+                                       '', ('127.0.0.1', port))], timeout=5)
+            self.assertTrue(sock.fileno() >= 1024)
+            self.assertEqual(_writable([sock], 1), [sock])
+            sock.close()
+        finally:
+            for fd in filler:
+                os.close(fd)
+            resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    def test_warmup(self):
+        server = Responder()
+        km = KM('key', host=server.host, pool=ConnectionPool())
+        self.assertEqual(km.warmup(2), 2)
+        self.assertEqual(km.warmup(2), 0)
+        km.identify('id')
+        km.record('action')
+        self.assertEqual(km.stats()['pool']['reused'], 1)
+        km._pool.clear()
+
+
+class TestRetry(unittest.TestCase):
+    def test_retries_server_errors(self):
+        from km.transport import ConnectionPool, HTTPStatusError, RetryPolicy
+        server = Responder(status=503)
+        pool = ConnectionPool(retry=RetryPolicy(retries=2, backoff=0.001))
+        self.assertRaises(HTTPStatusError, pool.send, server.host,
+                          'GET /e HTTP/1.1\r\n\r\n')
+        self.assertEqual(len(server.requests), 3)
+        pool.clear()
+
+    def test_client_errors_not_retried(self):
+        from km.transport import ConnectionPool, HTTPStatusError
+        server = Responder(status=400)
+        pool = ConnectionPool()
+        self.assertRaises(HTTPStatusError, pool.send, server.host,
+                          'GET /e HTTP/1.1\r\n\r\n')
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(pool.breaker(server.host).state, 'closed')
+        pool.clear()
+
+    def test_circuit_breaker(self):
+        from km.transport import CircuitBreaker
+        now = [0]
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=10,
+                                 clock=lambda: now[0])
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        now[0] = 10
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        now[0] = 20
+        self.assertTrue(breaker.allow())
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        self.assertTrue(breaker.allow())
+
+    def test_fail_fast(self):
+        from km.transport import (CircuitOpenError, ConnectionPool,
+                                  RetryPolicy)
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        host = '127.0.0.1:%d' % listener.getsockname()[1]
+        listener.close()
+        pool = ConnectionPool(retry=RetryPolicy(retries=0),
+                              failure_threshold=1)
+        self.assertRaises(socket.error, pool.send, host, 'GET / HTTP/1.1\r\n')
+        self.assertRaises(CircuitOpenError, pool.send, host,
+                          'GET / HTTP/1.1\r\n')
+
+    def test_spool_failures(self):
+        from km.transport import ConnectionPool, RetryPolicy
+        server = Responder(status=500)
+        with LogDir() as log_dir:
+            km = KM('key', host=server.host, log_dir=log_dir,
+                    spool_failures=True, logging=False,
+                    pool=ConnectionPool(retry=RetryPolicy(retries=0)))
+            km.identify('id')
+            km.record('action')
+            sent = []
+            km.spool.drain(sent.append)
+            self.assertEqual(len(sent), 1)
+            self.assertStartsWith(sent[0], '/e?')
+
+    def assertStartsWith(self, string, prefix):
+        self.assertTrue(string.startswith(prefix),
+                        '%r does not start with %r' % (string, prefix))
+
+
+class TestDispatcher(unittest.TestCase):
+    def test_flush(self):
+        from km.dispatcher import Dispatcher
+        sent = []
+        dispatcher = Dispatcher(sent.append, flush_interval=60)
+        for i in range(3):
+            dispatcher.put('/e?i=%d' % i)
+        dispatcher.flush()
+        self.assertEqual(sent, ['/e?i=0', '/e?i=1', '/e?i=2'])
+        self.assertEqual(dispatcher.stats()['sent'], 3)
+        dispatcher.close()
+
+    def test_drop_oldest(self):
+        from km.dispatcher import Dispatcher
+        sent = []
+        release = threading.Event()
+        def send(line):
+            release.wait()
+            sent.append(line)
+        dispatcher = Dispatcher(send, queue_size=2, batch_size=1)
+        dispatcher.put('/e?i=0')
+        while dispatcher._inflight == 0:
+            pass
+        for i in range(1, 4):
+            dispatcher.put('/e?i=%d' % i)
+        self.assertEqual(dispatcher.dropped, 1)
+        release.set()
+        dispatcher.close()
+        self.assertEqual(sent, ['/e?i=0', '/e?i=2', '/e?i=3'])
+
+    def test_spill(self):
+        from km.dispatcher import Dispatcher
+        spilled = []
+        release = threading.Event()
+        dispatcher = Dispatcher(lambda line: release.wait(), queue_size=1,
+                                flush_interval=60, overflow='spill',
+                                spill=spilled.append)
+        dispatcher.put('/e?i=0')
+        dispatcher.put('/e?i=1')
+        self.assertEqual(dispatcher.spilled, 1)
+        self.assertEqual(spilled, ['/e?i=1'])
+        release.set()
+        dispatcher.close()
+
+    def test_errors(self):
+        from km.dispatcher import Dispatcher
+        errors = []
+        def send(line):
+            raise IOError('down')
+        dispatcher = Dispatcher(send, lambda line, e: errors.append(line))
+        dispatcher.put('/e?i=0')
+        dispatcher.close()
+        self.assertEqual(errors, ['/e?i=0'])
+        self.assertEqual(dispatcher.failed, 1)
+
+    def test_batch_size(self):
+        from km.dispatcher import Dispatcher
+        batches = []
+        def send_batch(batch):
+            batches.append(len(batch))
+            return [None] * len(batch)
+        dispatcher = Dispatcher(None, batch_size=10, flush_interval=60,
+                                send_batch=send_batch)
+        for i in range(25):
+            dispatcher.put('/e?i=%d' % i)
+        dispatcher.flush()
+        self.assertEqual(sum(batches), 25)
+        self.assertTrue(max(batches) <= 10, batches)
+        self.assertEqual(dispatcher.sent, 25)
+        dispatcher.close()
+
+
+class TestSpool(unittest.TestCase):
+    def test_drain(self):
+        from km.spool import Spool
+        with LogDir() as log_dir:
+            spool = Spool(log_dir, segment_bytes=20)
+            for i in range(5):
+                spool.append('/e?i=%d' % i)
+            self.assertTrue(len(os.listdir(log_dir)) > 1)
+            sent = []
+            self.assertEqual(spool.drain(sent.append), (5, 0))
+            self.assertEqual(sent, ['/e?i=%d' % i for i in range(5)])
+            self.assertEqual(os.listdir(log_dir), [])
+
+    def test_resume(self):
+        from km.spool import Spool
+        with LogDir() as log_dir:
+            spool = Spool(log_dir, checkpoint_every=1)
+            for i in range(3):
+                spool.append('/e?i=%d' % i)
+            sent = []
+            def send(line):
+                if len(sent) == 1:
+                    raise IOError('down')
+                sent.append(line)
+            self.assertEqual(spool.drain(send), (1, 1))
+            spool.append('/e?i=3')
+            self.assertEqual(spool.drain(sent.append), (3, 0))
+            self.assertEqual(sent, ['/e?i=%d' % i for i in range(4)])
+
+    def test_one_sender(self):
+        from km.spool import Spool
+        with LogDir() as log_dir:
+            spool = Spool(log_dir)
+            for i in range(3):
+                spool.append('/e?i=%d' % i)
+            other = Spool(log_dir)
+            sent = []
+            def send(line):
+                if not sent:
+                    self.assertEqual(other.drain(sent.append), (0, 0))
+                sent.append(line)
+            self.assertEqual(spool.drain(send), (3, 0))
+            self.assertEqual(sent, ['/e?i=%d' % i for i in range(3)])
+            self.assertEqual(other.drain(sent.append), (0, 0))
+            self.assertTrue(other.lock_sender())
+            spool.append('/e?i=3')
+            self.assertEqual(spool.drain(sent.append), (0, 0))
+            other.unlock_sender()
+            self.assertEqual(spool.drain(sent.append), (1, 0))
+            spool.finish(os.path.join(log_dir, 'kissmetrics_sending.log.0'))
+
+    def test_cron_mode(self):
+        with LogDir() as log_dir:
+            server = Responder()
+            km = KM('key', host=server.host, use_cron=True, log_dir=log_dir)
+            km.identify('id')
+            km.record('action')
+            self.assertEqual(server.requests, [])
+            with StdIO() as stdio:
+                self.assertEqual(km_main('km', 'key', log_dir, server.host), 0)
+            self.assertEqual(len(server.requests), 1)
+            self.assertStartsWith(server.requests[0], 'GET /e?')
+            self.assertFalse(os.path.exists(km.log_name('query')))
+
+    def assertStartsWith(self, string, prefix):
+        self.assertTrue(string.startswith(prefix),
+                        '%r does not start with %r' % (string, prefix))
+
+
+def in_child(func):
+    # Run func in a forked child and return whether it returned True.
+    pid = os.fork()
+    if pid == 0:
+        try:
+            ok = func()
+        except BaseException:
+            ok = False
+        os._exit(0 if ok else 1)
+    return os.waitpid(pid, 0)[1] == 0
+
+
+class TestFork(unittest.TestCase):
+    def test_pool(self):
+        server = Responder()
+        pool = ConnectionPool()
+        pool.send(server.host, 'GET /e HTTP/1.1\r\n\r\n')
+        pool._pid = -1  # as if we had been forked
+        pool.send(server.host, 'GET /e HTTP/1.1\r\n\r\n')
+        self.assertEqual(server.connections, 2)
+        pool.clear()
+
+    def test_dispatcher(self):
+        from km.dispatcher import Dispatcher
+        sent = []
+        dispatcher = Dispatcher(sent.append, flush_interval=60)
+        dispatcher.put('/e?i=0')
+        dispatcher.flush()
+        def child():
+            dispatcher.put('/e?i=1')
+            dispatcher.flush()
+            return sent == ['/e?i=0', '/e?i=1']
+        self.assertTrue(in_child(child))
+        dispatcher.close()
+
+    def test_per_process_spool(self):
+        from km.spool import Spool
+        with LogDir() as log_dir:
+            spool = Spool(log_dir, per_process=True)
+            spool.append('/e?p=parent')
+            for i in range(2):
+                self.assertTrue(in_child(
+                    lambda: spool.append('/e?p=%d' % i) or True))
+            self.assertEqual(len(os.listdir(log_dir)), 3)
+            sent = []
+            self.assertEqual(Spool(log_dir).drain(sent.append), (3, 0))
+            self.assertEqual(sorted(sent),
+                             ['/e?p=0', '/e?p=1', '/e?p=parent'])
+            spool.append('/e?p=parent')
+            self.assertEqual(Spool(log_dir).drain(sent.append), (1, 0))
+            spool.close()
+
+    def test_error_log(self):
+        import km.log
+        with LogDir() as log_dir:
+            km_ = KM('key', log_dir=log_dir)
+            km_.logm('parent')
+            km.log.flush()
+            def child():
+                km_.logm('child')
+                km.log.flush()
+                return True
+            self.assertTrue(in_child(child))
+            lines = open(km_.log_file()).readlines()
+            self.assertEqual([line.split('> ')[1] for line in lines],
+                             ['parent\n', 'child\n'])
+            km.log.shutdown()
+
+
+class TestStats(unittest.TestCase):
+    def test_stats(self):
+        server = Responder()
+        calls = []
+        km = KM('key', host=server.host, pool=ConnectionPool(),
+                before_send=lambda line: calls.append('before'),
+                after_send=lambda line, seconds: calls.append('after'))
+        km.identify('id')
+        for i in range(3):
+            km.record('action')
+        km.identify('Googlebot/2.1', user_agent='Googlebot/2.1')
+        km.record('action')
+        stats = km.stats()
+        self.assertEqual((stats['enqueued'], stats['sent'], stats['failed']),
+                         (3, 3, 0))
+        self.assertEqual(stats['dropped'], 1)
+        self.assertEqual(stats['bytes_sent'],
+                         sum(len(request) + 4 for request in server.requests))
+        self.assertEqual(stats['latency']['count'], 3)
+        self.assertEqual(stats['pool']['reused'], 2)
+        self.assertEqual(calls, ['before', 'after'] * 3)
+        km._pool.clear()
+
+    def test_on_error(self):
+        server = Responder(status=400)
+        errors = []
+        km = KM('key', host=server.host, logging=False, pool=ConnectionPool(),
+                on_error=lambda line, error: errors.append(error))
+        km.identify('id')
+        km.record('action')
+        self.assertEqual(km.stats()['failed'], 1)
+        self.assertEqual(str(errors[0]), 'HTTP 400 from ' + server.host)
+        km._pool.clear()
+
+    def test_histogram(self):
+        from km.stats import Histogram
+        histogram = Histogram()
+        self.assertEqual(histogram.percentile(0.5), None)
+        for seconds in [0.0001] * 98 + [0.2, 20]:
+            histogram.observe(seconds)
+        self.assertEqual(histogram.percentile(0.5), 0.0005)
+        self.assertEqual(histogram.percentile(0.99), 0.25)
+        self.assertEqual(histogram.percentile(1), None)
+        self.assertEqual(histogram.snapshot()['count'], 100)
+
+
+class TestBench(unittest.TestCase):
+    def test_one_shot_baseline(self):
+        from bench import OneShotKM
+        server = Responder()
+        km = OneShotKM('key', host=server.host)
+        km.identify('id')
+        for i in range(3):
+            km.record('action', {'i': i})
+        deadline = time.time() + 5
+        while len(server.requests) < 3 and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(len(server.requests), 3)
+        self.assertEqual(server.connections, 3)
+
+
+class TestTesting(unittest.TestCase):
+    def test_recording_transport(self):
+        from km.testing import RecordingTransport
+        transport = RecordingTransport()
+        km = KM('key', pool=transport)
+        km.identify('bob')
+        km.record('Signed Up', {'plan': 'pro'})
+        km.set({'gender': 'm'})
+        km.alias('bob', 'robert')
+        event = transport.events[0]
+        self.assertEqual((event['_n'], event['_p'], event['_k'],
+                          event['plan']), ('Signed Up', 'bob', 'key', 'pro'))
+        self.assertTrue(event['_t'].isdigit())
+        self.assertEqual(transport.sets[0]['gender'], 'm')
+        self.assertEqual(transport.aliases[0]['_n'], 'robert')
+        self.assertEqual(km.stats()['pool'], {'requests': 3})
+
+    def test_bulk(self):
+        from km.testing import RecordingTransport
+        transport = RecordingTransport()
+        km = KM('key', logging=False, pool=transport)
+        self.assertEqual(km.record_many(('user%d' % i, 'action', {})
+                                        for i in range(1000)), (1000, 0))
+        self.assertEqual(len(transport.events), 1000)
+        transport.status = 503
+        self.assertEqual(km.record_many([('user', 'action', {})]), (0, 1))
+
+    def test_loopback_server(self):
+        from km.testing import LoopbackServer
+        with LoopbackServer() as server:
+            km = KM('key', host=server.host, pool=ConnectionPool())
+            km.identify('bob')
+            km.record('Signed Up')
+            self.assertEqual(server.events[0]['_n'], 'Signed Up')
+            km._pool.clear()
+
+
+class TestEncoding(unittest.TestCase):
+    lines = ['/e?_k=key&_p=user%d&_n=signed+up&plan=p%%26r%d' % (i, i)
+             for i in range(7)]
+
+    def test_batches(self):
+        from km.encoding import PostEncoder, decode, parse_query
+        for format in ('jsonl', 'form'):
+            for gzip in (True, False):
+                encoder = PostEncoder(format, gzip=gzip, max_events=3)
+                batches = encoder.batches('host', self.lines)
+                self.assertEqual([count for data, count in batches],
+                                 [3, 3, 1])
+                received = sum((decode(data) for data, count in batches), [])
+                self.assertEqual(map(parse_query, received),
+                                 map(parse_query, self.lines))
+        encoder = PostEncoder('form', gzip=False,
+                              max_bytes=len(self.lines[0]) * 2 + 2)
+        self.assertEqual([count for data, count
+                          in encoder.batches('host', self.lines)],
+                         [2, 2, 2, 1])
+        self.assertRaises(ValueError, PostEncoder, 'xml')
+
+    def test_non_utf8_values(self):
+        from km.encoding import PostEncoder, decode
+        from km.testing import RecordingTransport
+        bad = '/e?_k=key&_p=user&_n=moved&city=Montr%E9al'
+        lines = self.lines[:2] + [bad] + self.lines[2:4]
+        encoder = PostEncoder('jsonl')
+        batches = encoder.batches('host', lines)
+        self.assertEqual([count for data, count in batches], [2, 1, 2])
+        self.assertEqual(sum((decode(data) for data, count in batches), [])[2],
+                         bad)
+        self.assertTrue(encoder.request('host', bad).startswith('GET '))
+        transport = RecordingTransport()
+        km = KM('key', pool=transport, encoder=encoder)
+        self.assertEqual(km.send_queries(lines), [None] * 5)
+        km.identify('user')
+        km.record('moved', {'city': 'Montr\xe9al'})
+        self.assertEqual(transport.events[-1]['city'], 'Montr\xe9al')
+
+    def test_encoding_error(self):
+        from km.encoding import PostEncoder
+        from km.testing import RecordingTransport
+        class Picky(PostEncoder):
+            def encode_line(self, line):
+                if 'bad' in line:
+                    raise ValueError(line)
+                return PostEncoder.encode_line(self, line)
+        errors = []
+        transport = RecordingTransport()
+        km = KM('key', logging=False, pool=transport, encoder=Picky(),
+                on_error=lambda line, error: errors.append(line))
+        lines = ['/e?_n=ok', '/e?_n=bad', '/e?_n=ok2']
+        self.assertEqual([type(error) for error in km.send_queries(lines)],
+                         [type(None), ValueError, type(None)])
+        self.assertEqual(transport.lines, ['/e?_n=ok', '/e?_n=ok2'])
+        km.identify('user')
+        km.record('bad')
+        self.assertEqual(km.stats()['failed'], 2)
+        self.assertEqual(len(errors), 2)
+
+    def test_post_request(self):
+        from km.encoding import PostEncoder
+        data = PostEncoder(gzip=True).request('host', self.lines[0])
+        head, body = data.split('\r\n\r\n', 1)
+        self.assertTrue(head.startswith('POST /batch HTTP/1.1\r\n'))
+        self.assertTrue('Content-Encoding: gzip' in head)
+        self.assertTrue('Content-Length: %d' % len(body) in head)
+
+    def test_drain(self):
+        from km.encoding import PostEncoder, parse_query
+        from km.testing import RecordingTransport
+        with LogDir() as log_dir:
+            transport = RecordingTransport()
+            km = KM('key', pool=transport, log_dir=log_dir,
+                    encoder=PostEncoder(max_events=4))
+            for line in self.lines:
+                km.spool.append(line)
+            km.send_logged_queries()
+            self.assertEqual(transport.queries, map(parse_query, self.lines))
+            self.assertEqual(transport.requests, 2)
+            self.assertEqual(km.stats()['sent'], 7)
+
+    def test_background(self):
+        from km.encoding import PostEncoder
+        from km.testing import LoopbackServer
+        with LoopbackServer() as server:
+            km = KM('key', host=server.host, pool=ConnectionPool(),
+                    background=True, encoder=PostEncoder('form'))
+            km.identify('bob')
+            for i in range(5):
+                km.record('Signed Up', {'i': str(i)})
+            km.close()
+            self.assertEqual([event['i'] for event in server.events],
+                             ['0', '1', '2', '3', '4'])
+            km._pool.clear()
+
+
+class TestReplay(unittest.TestCase):
+    def test_replay(self):
+        with LogDir() as log_dir:
+            server = Responder()
+            km = KM('key', host=server.host, log_dir=log_dir)
+            now = int(time.time())
+            lines = ['/e?_k=key&_p=user%d&_n=e%d&_t=%d' % (i % 3, i, now)
+                     for i in range(30)]
+            for line in lines + lines[:5]:
+                km.spool.append(line)
+            km.spool.append('/e?_k=key&_p=user0&_n=old&_t=%d' % (now - 7200))
+            progress = km.replay(workers=3, horizon=3600, window=7)
+            self.assertEqual(progress[:4], (30, 0, 5, 1))
+            self.assertTrue(progress.rate > 0)
+            received = [request.split()[1] for request in server.requests]
+            self.assertEqual(sorted(received), sorted(lines))
+            for user in range(3):
+                self.assertEqual(
+                    [line for line in received if '_p=user%d&' % user in line],
+                    [line for line in lines if '_p=user%d&' % user in line])
+            self.assertEqual(os.listdir(log_dir), [])
+
+    def test_resume(self):
+        from km.testing import RecordingTransport
+        with LogDir() as log_dir:
+            transport = RecordingTransport(status=503)
+            km = KM('key', logging=False, pool=transport, log_dir=log_dir)
+            for i in range(10):
+                km.spool.append('/e?_k=key&_p=user%d&_n=e' % i)
+            progress = km.replay(workers=2, window=4)
+            self.assertEqual((progress.sent, progress.failed), (0, 4))
+            transport.status = 200
+            self.assertEqual(km.replay(workers=2, window=4).sent, 10)
+            self.assertEqual(len(transport.events), 10)
+
+    def test_dedupe_window(self):
+        from km.testing import RecordingTransport
+        with LogDir() as log_dir:
+            transport = RecordingTransport()
+            km = KM('key', logging=False, pool=transport, log_dir=log_dir)
+            for name in 'abacdea':
+                km.spool.append('/e?_k=key&_p=user&_n=' + name)
+            progress = km.replay(workers=1, dedupe_size=2)
+            self.assertEqual((progress.sent, progress.duplicates), (6, 1))
+
+    def test_failed_identity_keeps_order(self):
+        from km.testing import RecordingTransport
+        from km.transport import HTTPStatusError
+        class Flaky(RecordingTransport):
+            def send(self, host, data):
+                if '_n=e0&_p=user0' in data and not self.lines:
+                    raise HTTPStatusError(503, host)
+                return RecordingTransport.send(self, host, data)
+        with LogDir() as log_dir:
+            transport = Flaky()
+            km = KM('key', logging=False, pool=transport, log_dir=log_dir)
+            for i in range(3):
+                for user in range(2):
+                    km.spool.append('/e?_k=key&_n=e%d&_p=user%d' % (i, user))
+            self.assertEqual(km.replay(workers=1, window=2,
+                                       batch_size=1).sent, 3)
+            self.assertEqual(km.replay(workers=1).sent, 3)
+            self.assertEqual([params['_n'] for params in transport.events
+                              if params['_p'] == 'user0'],
+                             ['e0', 'e1', 'e2'])
+
+        # a2 fails, then the tracker goes down while a3 is held back.
+        class Outage(RecordingTransport):
+            down = None
+            def send(self, host, data):
+                if self.down or (self.down is None and '_n=a2' in data):
+                    self.down = True
+                    raise HTTPStatusError(503, host)
+                return RecordingTransport.send(self, host, data)
+        with LogDir() as log_dir:
+            transport = Outage()
+            km = KM('key', logging=False, pool=transport, log_dir=log_dir)
+            for name in ('a1', 'a2', 'a3'):
+                km.spool.append('/e?_k=key&_n=%s&_p=A' % name)
+            km.spool.append('/e?_k=key&_n=b1&_p=B')
+            self.assertEqual(km.replay(workers=1, window=2,
+                                       batch_size=1).sent, 1)
+            transport.down = False
+            transport.status = 200
+            km.replay(workers=1)
+            self.assertEqual([params['_n'] for params in transport.events],
+                             ['a1', 'a2', 'a3', 'b1'])
+
+    def test_rejects_refused_lines(self):
+        from km.spool import REJECTED_LOG
+        from km.testing import RecordingTransport
+        with LogDir() as log_dir:
+            transport = RecordingTransport(status=400)
+            km = KM('key', logging=False, pool=transport, log_dir=log_dir)
+            for i in range(10):
+                km.spool.append('/e?_k=key&_p=user%d&_n=e' % i)
+            progress = km.replay(workers=2, window=4)
+            self.assertEqual((progress.sent, progress.failed), (0, 10))
+            self.assertEqual(os.listdir(log_dir), [REJECTED_LOG])
+
+    def test_main(self):
+        with LogDir() as log_dir:
+            server = Responder()
+            km = KM('key', use_cron=True, log_dir=log_dir)
+            km.identify('id')
+            for i in range(3):
+                km.record('action', {'i': i})
+            with StdIO() as stdio:
+                self.assertEqual(km_main('km', 'key', log_dir, server.host,
+                                         '--workers', '2'), 0)
+            self.assertEqual(len(server.requests), 3)
+
+
+class TestAsyncKM(unittest.TestCase):
+    def test_record(self):
+        from km.asynckm import AsyncKM
+        server = Responder()
+        km = AsyncKM('key', host=server.host, concurrency=2)
+        km.identify('id')
+        result = km.record('action', {'_t': 1})
+        self.assertEqual(result.get(5), None)
+        sync = KM('key')
+        sync.identify('id')
+        expected = sync.query_line('e', {'_n': 'action', '_t': 1})
+        self.assertEqual(server.requests[0].split('\r\n')[0],
+                         'GET %s HTTP/1.1' % expected)
+        km.close()
+
+    def test_error(self):
+        from km.asynckm import AsyncKM
+        from km.transport import TransportError
+        server = Responder(status=500)
+        km = AsyncKM('key', host=server.host, logging=False)
+        km.identify('id')
+        self.assertRaises(TransportError, km.record('action').get, 5)
+        km.track_nowait('action')
+        km.flush()
+        km.close()
+
+    def test_dropped(self):
+        from km.asynckm import AsyncKM
+        from km.ratelimit import EventSampler
+        from km.testing import RecordingTransport
+        transport = RecordingTransport()
+        km = AsyncKM('key', pool=transport, sampler=EventSampler(
+            rates={'sampled': 0}))
+        km.identify('id', user_agent='Googlebot/2.1')
+        self.assertTrue(km.record('action').wait(1))
+        self.assertTrue(km.set({'a': 1}).wait(1))
+        km.identify('id')
+        self.assertEqual(km.record('sampled').get(1), None)
+        km.close()
+        self.assertEqual(transport.lines, [])
+
+
+class TestQuerySerializer(unittest.TestCase):
+    def test_line(self):
+        from km.query import QuerySerializer
+        serializer = QuerySerializer(clock=lambda: 1.5)
+        line = serializer.line('e', {'_n': 'a b', 'n': 2}, 'key', 'id')
+        bits = urlparse.urlsplit(line)
+        self.assertEqual(bits[2], '/e')
+        self.assertEqual(dict(parse_qsl(bits[3])),
+                         {'_n': 'a b', 'n': '2', '_k': 'key', '_p': 'id',
+                          '_t': '1'})
+
+    def test_custom_time(self):
+        from km.query import QuerySerializer
+        line = QuerySerializer().line('e', {'_t': 5, '_p': 'x', '_k': 'x'},
+                                      'key', 'id')
+        self.assertEqual(dict(parse_qsl(urlparse.urlsplit(line)[3])),
+                         {'_k': 'key', '_p': 'id', '_t': '5', '_d': '1'})
+
+    def test_alias(self):
+        from km.query import QuerySerializer
+        line = QuerySerializer(clock=lambda: 1).line(
+            'a', {'_n': 'to', '_p': 'from'}, 'key', update=False)
+        self.assertEqual(dict(parse_qsl(urlparse.urlsplit(line)[3])),
+                         {'_k': 'key', '_n': 'to', '_p': 'from', '_t': '1'})
+
+
+class TestEvent(unittest.TestCase):
+    def test_line(self):
+        from km.query import Event, QuerySerializer
+        serializer = QuerySerializer(clock=lambda: 1)
+        line = Event('e', 'id', 'a b', {'_n': 'x', 'n': 2}).line('key',
+                                                                  serializer)
+        self.assertEqual(dict(parse_qsl(urlparse.urlsplit(line)[3])),
+                         {'_n': 'a b', 'n': '2', '_k': 'key', '_p': 'id',
+                          '_t': '1'})
+        line = Event('s', 'id', props={'n': 2}, timestamp=5).line(
+            'key', serializer)
+        self.assertEqual(dict(parse_qsl(urlparse.urlsplit(line)[3])),
+                         {'n': '2', '_k': 'key', '_p': 'id', '_t': '5',
+                          '_d': '1'})
+        self.assertFalse(hasattr(Event('e'), '__dict__'))
+
+    def test_props_not_modified(self):
+        from km.ratelimit import EventSampler
+        from km.testing import RecordingTransport
+        km = KM('key', pool=RecordingTransport(),
+                sampler=EventSampler(default_rate=0.9999))
+        km.identify('id')
+        props = {'plan': 'pro'}
+        km.record('first', props)
+        km.record('second')
+        km.set(props)
+        self.assertEqual(props, {'plan': 'pro'})
+        self.assertEqual(KM.record.im_func.func_defaults, (None, None, None))
+        first, second = km._pool.events
+        self.assertEqual(first['sample_rate'], '0.9999')
+        self.assertEqual((first['_n'], second['_n']), ('first', 'second'))
+        self.assertFalse('plan' in second)
+
+    def test_record_dict(self):
+        from km.ratelimit import EventSampler
+        from km.testing import RecordingTransport
+        transport = RecordingTransport()
+        km = KM('key', pool=transport, sampler=EventSampler())
+        km.identify('bob')
+        km.record({'plan': 'pro'})
+        self.assertEqual(transport.sets[0]['plan'], 'pro')
+        self.assertEqual(transport.events[0]['_n'], str({'plan': 'pro'}))
+
+
+class TestSharedKM(unittest.TestCase):
+    def test_per_call_identity(self):
+        server = Responder()
+        km = KM('key', host=server.host, pool=ConnectionPool())
+        self.assertRaises(Exception, km.record, 'action')
+        def track(n):
+            user = km.bind('user%d' % n)
+            for i in range(20):
+                user.record('action', {'i': n})
+        threads = [threading.Thread(target=track, args=(n,))
+                   for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(server.requests), 80)
+        for request in server.requests:
+            path = request.split(' ')[1]
+            params = dict(parse_qsl(urlparse.urlsplit(path)[3]))
+            self.assertEqual(params['_p'], 'user' + params['i'])
+        km._pool.clear()
+
+
+class TestRobotFilter(unittest.TestCase):
+    def test_filter(self):
+        server = Responder()
+        km = KM('key', host=server.host)
+        robot = 'Mozilla/5.0 (compatible; Googlebot/2.1)'
+        browser = 'Mozilla/5.0 (X11; U; Linux i686; en-US)'
+        km.identify('id', user_agent=robot)
+        props = {}
+        self.assertEqual(km.record('action', props), None)
+        self.assertEqual(props, {})
+        km.set({'a': 1})
+        km.record('action', user_agent=browser)
+        km.bind('other', robot).record('action')
+        km.bind('other', browser).record('action')
+        km.record('action', identity='other')
+        self.assertEqual(km.robots_filtered, 3)
+        self.assertEqual(len(server.requests), 3)
+
+    def test_non_ascii_user_agent(self):
+        from km.testing import RecordingTransport
+        transport = RecordingTransport()
+        km = KM('key', pool=transport)
+        for user_agent in ('Mozilla/5.0 (X11; Linux) caf\xc3\xa9 Firefox/3',
+                           'Mozilla/5.0 (X11; Linux) caf\xe9 Firefox/3',
+                           'caf\xe9bot/1.0'):
+            km.identify('id', user_agent=user_agent)
+            km.record('action')
+            km.set({'a': 1})
+        self.assertEqual(len(transport.lines), 4)
+        self.assertEqual(km.robots_filtered, 2)
+
+
+class TestSampling(unittest.TestCase):
+    def test_token_bucket(self):
+        from km.ratelimit import TokenBucket
+        now = [0]
+        bucket = TokenBucket(2, burst=2, clock=lambda: now[0])
+        self.assertTrue(bucket.consume())
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+        now[0] = 0.5
+        self.assertTrue(bucket.consume())
+        self.assertFalse(bucket.consume())
+
+    def test_sampling_is_per_identity(self):
+        from km.ratelimit import EventSampler
+        sampler = EventSampler(rates={'view': 0.25})
+        kept = [i for i in range(1000)
+                if sampler.admit('view', 'user%d' % i) is not None]
+        self.assertTrue(150 < len(kept) < 350, len(kept))
+        for i in range(1000):
+            self.assertEqual(sampler.admit('view', 'user%d' % i) is not None,
+                             i in kept)
+        self.assertEqual(sampler.admit('click', 'user0'), 1.0)
+
+    def test_record(self):
+        from km.ratelimit import EventSampler
+        server = Responder()
+        sampler = EventSampler(rates={'view': 0.5}, limits={'click': 1})
+        km = KM('key', host=server.host, sampler=sampler)
+        for i in range(20):
+            km.record('view', {}, identity='user%d' % i)
+            km.record('click', {}, identity='user%d' % i)
+        views = [dict(parse_qsl(urlparse.urlsplit(r.split(' ')[1])[3]))
+                 for r in server.requests if '_n=view' in r]
+        self.assertEqual(len(views) + sampler.sampled_out['view'], 20)
+        self.assertEqual(views[0]['sample_rate'], '0.5')
+        self.assertEqual(sampler.rate_limited['click'], 19)
+
+
+class TestCoalesce(unittest.TestCase):
+    def params(self, request):
+        return dict(parse_qsl(urlparse.urlsplit(request.split(' ')[1])[3]))
+
+    def test_suppress_unchanged(self):
+        from km.coalesce import SetCoalescer
+        server = Responder()
+        now = [0]
+        coalescer = SetCoalescer(ttl=10, clock=lambda: now[0])
+        km = KM('key', host=server.host, coalescer=coalescer)
+        km.identify('id')
+        km.set({'plan': 'pro', 'locale': 'en'})
+        km.set({'plan': 'pro', 'locale': 'en'})
+        km.set({'plan': 'pro', 'locale': 'fr'})
+        km.set({'plan': 'pro'}, identity='other')
+        now[0] = 10
+        km.set({'plan': 'pro'})
+        params = [self.params(r) for r in server.requests]
+        self.assertEqual(len(params), 4)
+        self.assertEqual(params[1]['locale'], 'fr')
+        self.assertFalse('plan' in params[1])
+        self.assertEqual(params[2]['_p'], 'other')
+        self.assertEqual(coalescer.stats()['suppressed'], 3)
+
+    def test_window(self):
+        from km.coalesce import SetCoalescer
+        server = Responder()
+        coalescer = SetCoalescer(window=60)
+        km = KM('key', host=server.host, coalescer=coalescer)
+        km.identify('id')
+        km.set({'plan': 'pro'})
+        km.set({'locale': 'en'})
+        km.set({'plan': 'pro'})
+        self.assertEqual(server.requests, [])
+        km.flush()
+        self.assertEqual(len(server.requests), 1)
+        params = self.params(server.requests[0])
+        self.assertEqual((params['plan'], params['locale']), ('pro', 'en'))
+        self.assertEqual(coalescer.merged, 1)
+
+    def test_failed_send_not_suppressed(self):
+        from km.coalesce import SetCoalescer
+        from km.testing import RecordingTransport
+        transport = RecordingTransport(status=503)
+        km = KM('key', logging=False, pool=transport,
+                coalescer=SetCoalescer())
+        km.identify('id')
+        km.set({'plan': 'pro', 'locale': 'en'})
+        transport.status = 200
+        km.set({'plan': 'pro', 'locale': 'en'})
+        km.set({'plan': 'pro', 'locale': 'en'})
+        self.assertEqual(transport.sets, [{'_k': 'key', '_p': 'id',
+                                           '_t': transport.sets[0]['_t'],
+                                           'plan': 'pro', 'locale': 'en'}])
+
+    def test_lru(self):
+        from km.coalesce import SetCoalescer
+        coalescer = SetCoalescer(maxsize=2)
+        coalescer.changed('a', {'x': 1})
+        coalescer.changed('b', {'x': 1})
+        coalescer.changed('a', {'x': 1})
+        coalescer.changed('c', {'x': 1})
+        self.assertEqual(coalescer.changed('a', {'x': 1}), {})
+        self.assertEqual(coalescer.changed('b', {'x': 1}), {'x': '1'})
+
+
+class TestBulk(unittest.TestCase):
+    def params(self, request):
+        path = request.split(' ')[1]
+        return dict(parse_qsl(urlparse.urlsplit(path)[3]))
+
+    def test_record_many(self):
+        server = Responder()
+        km = KM('key', host=server.host)
+        batches = []
+        events = (('user%d' % i, 'action', {'i': i}, 100 + i if i % 2 else None)
+                  for i in range(5))
+        self.assertEqual(km.record_many(events, batch_size=2,
+                                        on_batch=batches.append), (5, 0))
+        self.assertEqual([(b.start, b.end, b.sent) for b in batches],
+                         [(0, 2, 2), (2, 4, 2), (4, 5, 1)])
+        params = sorted((self.params(r) for r in server.requests),
+                        key=lambda p: p['i'])
+        self.assertEqual(params[1]['_p'], 'user1')
+        self.assertEqual(params[1]['_t'], '101')
+        self.assertEqual(params[1]['_d'], '1')
+        self.assertFalse('_d' in params[0])
+
+    def test_identify_fallback(self):
+        from km.testing import RecordingTransport
+        transport = RecordingTransport()
+        km = KM('key', pool=transport)
+        km.identify('bob')
+        km.record_many([(None, 'action', {})])
+        km.set_many([(None, {'a': 1})])
+        self.assertEqual([params['_p'] for params in transport.events +
+                          transport.sets], ['bob', 'bob'])
+
+    def test_failures(self):
+        server = Responder(status=500)
+        km = KM('key', host=server.host, logging=False)
+        self.assertEqual(km.set_many([('id', {'a': 1})] * 3), (0, 3))
+        self.assertEqual(km.alias_many([('a', 'b')]), (0, 1))
+
+
+class TestImporter(unittest.TestCase):
+    def test_import_resume(self):
+        server = Responder()
+        with LogDir() as log_dir:
+            path = os.path.join(log_dir, 'events.csv')
+            checkpoint = os.path.join(log_dir, 'checkpoint')
+            fh = open(path, 'w')
+            fh.write('user,event,when,plan\n'
+                     'u1,signed up,100,pro\n'
+                     ',missing user,,\n'
+                     'u2,signed up,,\n')
+            fh.close()
+            args = ('kissmetrics', 'import', 'key', path, '--host',
+                    server.host, '--identity-column', 'user',
+                    '--event-column', 'event', '--time-column', 'when',
+                    '--checkpoint', checkpoint)
+            with StdIO() as stdio:
+                self.assertEqual(km_main(*args), 0)
+            self.assertEqual(open(checkpoint).read(), '3')
+            params = sorted((dict(parse_qsl(urlparse.urlsplit(
+                request.split(' ')[1])[3])) for request in server.requests),
+                key=lambda params: params['_p'])
+            self.assertEqual(params[0]['_p'], 'u1')
+            self.assertEqual(params[0]['_n'], 'signed up')
+            self.assertEqual(params[0]['_t'], '100')
+            self.assertEqual(params[0]['plan'], 'pro')
+            self.assertEqual(params[1]['_p'], 'u2')
+            self.assertFalse('plan' in params[1])
+            with StdIO() as stdio:
+                self.assertEqual(km_main(*args), 0)
+            self.assertEqual(len(server.requests), 2)
+
+    def test_invalid_json(self):
+        server = Responder()
+        with LogDir() as log_dir:
+            path = os.path.join(log_dir, 'events.jsonl')
+            fh = open(path, 'w')
+            fh.write('{"_p": "u1", "_n": "signed up"}\n'
+                     '{"_p": "u2", "_n": \n'
+                     '["u3", "signed up"]\n'
+                     '{"_p": "u4", "_n": "signed up"}\n'
+                     '{"_p": "u5", "_n": "e2", "citt\xc3\xa0": "Roma"}\n')
+            fh.close()
+            with StdIO() as stdio:
+                self.assertEqual(km_main('kissmetrics', 'import', 'key', path,
+                                         '--host', server.host), 0)
+            self.assertTrue('2 invalid' in stdio.stdout.getvalue())
+            self.assertEqual(len(server.requests), 3)
+            self.assertTrue([request for request in server.requests
+                             if 'citt%C3%A0=Roma' in request])
+
+
+def reference_is_robot(user_agent):
+    # km.helpers.is_robot before it was compiled and cached.
+    import re
+    if user_agent:
+        user_agent = unicode(user_agent).lower()
+        for agent in ('w3m', 'dillo', 'links', 'elinks', 'lynx'):
+            if agent in user_agent:
+                return False
+        for agent in ('bot', 'spider', 'search', 'jeeves', 'crawl', 'seek',
+                      'heritrix', 'slurp', 'thumbnails', 'capture', 'ferret',
+                      'webinator', 'scan', 'retriever', 'accelerator',
+                      'upload', 'digg', 'extractor', 'grub', 'scrub'):
+            if agent in user_agent:
+                return True
+        for agent in ('mozilla', 'browser', 'iphone', 'lynx', 'mobile',
+                      'opera', 'icab'):
+            if agent in user_agent:
+                break
+        else:
+            return True
+        if 'mozilla' in user_agent:
+            if '(' not in user_agent:
+                return True
+            if not re.search(r'mozilla/\d+', user_agent):
+                return True
+    return False
+
+
+USER_AGENTS = [
+    '', 'Dillo/0.8.5', 'dCSbot/1.1', 'Opera/9.80', 'Mozilla', 'Mozilla/5.0',
+    'Mozilla/5.0 (X11; U; Linux i686; en-US)',
+    'Mozilla/5.0 (compatible; Googlebot/2.1; +http://www.google.com/bot.html)',
+    'Mozilla/5.0 (iPhone; CPU iPhone OS 5_0 like Mac OS X) Mobile/9A334',
+    'Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/535.19 Chrome/18.0',
+    'Mozilla/4.0 (compatible; MSIE 8.0; Windows NT 6.1; Trident/4.0)',
+    'Mozilla/5.0 (compatible; Yahoo! Slurp)', 'msnbot/2.0b',
+    'Lynx/2.8.7rel.2 libwww-FM/2.14', 'ELinks/0.12pre5 (textmode)',
+    'w3m/0.5.2', 'Wget/1.13.4', 'curl/7.21.4', 'python-urllib/2.7',
+    'iCab/4.8 (Macintosh; U; Intel Mac OS X)', 'icabot', 'Mozilla (foo)',
+    'Mozilla/x (foo)', 'Opera Mini browser', u'Mozilla/5.0 (\xe9t\xe9)',
+]
+
+
+class TestErrorLog(unittest.TestCase):
+    def test_logm(self):
+        import km.log
+        with LogDir() as log_dir:
+            km_ = KM('key', log_dir=log_dir)
+            for i in range(3):
+                km_.logm('Error')
+            km_.logm('Other')
+            km.log.flush()
+            lines = open(km_.log_file()).readlines()
+            self.assertEqual(len(lines), 2)
+            self.assertStartsWith(lines[0], '<')
+            self.assertEndsWith(lines[0], '> Error\n')
+            self.assertEndsWith(lines[1], '> Other\n')
+            km.log.shutdown()
+
+    def test_repeat_filter(self):
+        import logging
+        from km.log import RepeatFilter
+        repeat = RepeatFilter(interval=0)
+        record = logging.LogRecord('km', logging.ERROR, '', 0, 'Error', None,
+                                   None)
+        self.assertTrue(repeat.filter(record))
+        self.assertTrue(repeat.filter(record))
+        repeat.interval = 60
+        self.assertFalse(repeat.filter(record))
+        repeat.interval = 0
+        self.assertTrue(repeat.filter(record))
+        self.assertEqual(record.getMessage(),
+                         'Error (1 similar messages suppressed)')
+
+    def assertStartsWith(self, string, prefix):
+        self.assertTrue(string.startswith(prefix),
+                        '%r does not start with %r' % (string, prefix))
+
+    def assertEndsWith(self, string, suffix):
+        self.assertTrue(string.endswith(suffix),
+                        '%r does not end with %r' % (string, suffix))
+
+
 class TestHelpers(unittest.TestCase):
     def test_is_robot(self):
         from km.helpers import is_robot
@@ -380,6 +1684,67 @@ class TestHelpers(unittest.TestCase):
         self.assertTrue(is_robot('Mozilla/5.0'))
         self.assertTrue(is_robot('Mozilla'))
 
+    def test_matches_reference(self):
+        import random
+        from km.helpers.is_robot import classify, default_detector, is_robot
+        signatures = default_detector.signatures
+        # Random strings glued from indicator fragments exercise overlapping
+        # and adjacent matches.
+        pieces = tuple(signatures['whitelist'] + signatures['bot'] +
+                       signatures['browser'] +
+                       ['mozilla/', '5', '(', ')', ' ', 'x', 'b', 'o', 't'])
+        rng = random.Random(0)
+        corpus = list(USER_AGENTS)
+        for i in range(5000):
+            corpus.append(''.join(rng.choice(pieces)
+                                  for j in range(rng.randint(1, 6))))
+        for user_agent in corpus:
+            expected = reference_is_robot(user_agent)
+            self.assertEqual(classify(user_agent), expected, user_agent)
+            self.assertEqual(is_robot(user_agent), expected, user_agent)
+            self.assertEqual(is_robot(user_agent.upper()), expected, user_agent)
+
+    def test_cache(self):
+        from km.helpers.is_robot import LRUCache
+        cache = LRUCache(maxsize=2)
+        cache.get('a', len)
+        cache.get('b', len)
+        cache.get('a', len)
+        cache.get('c', len)
+        self.assertEqual(cache.info(), {'hits': 1, 'misses': 3, 'size': 2,
+                                        'maxsize': 2})
+        calls = []
+        cache.get('a', calls.append)
+        cache.get('b', calls.append)
+        self.assertEqual(calls, ['b'])
+
+    def test_detector_reload(self):
+        import json
+        from km.helpers import RobotDetector
+        with LogDir() as log_dir:
+            path = os.path.join(log_dir, 'signatures.json')
+            def write(signatures):
+                fh = open(path, 'w')
+                json.dump(signatures, fh)
+                fh.close()
+            signatures = {'whitelist': [], 'bot': ['bot'],
+                          'browser': ['mozilla']}
+            write(signatures)
+            detector = RobotDetector(path)
+            self.assertFalse(detector.is_robot('Mozilla/5.0 (X) NewCrawler'))
+            signatures['bot'].append('newcrawler')
+            write(signatures)
+            os.utime(path, (0, 0))
+            self.assertTrue(detector.reload_if_changed())
+            self.assertFalse(detector.reload_if_changed())
+            self.assertTrue(detector.is_robot('Mozilla/5.0 (X) NewCrawler'))
+            self.assertEqual(detector.cache_info()['hits'], 0)
+
+    def test_is_robot_many(self):
+        from km.helpers import is_robot_many
+        self.assertEqual(is_robot_many(USER_AGENTS),
+                         [reference_is_robot(ua) for ua in USER_AGENTS])
+
 
 class TestMain(TestCase):
     def test_args(self):